@@ -1,4 +1,5 @@
 import sys,logging,os,time,argparse
+startup_time = time.time()
 import cv2
 import numpy as np
 from PyQt5.QtWidgets import QApplication, QMainWindow
@@ -7,31 +8,41 @@ from PyQt5 import QtCore
 from PyQt5.QtCore import QThread
 from PyQt5 import QtWidgets
 from PyQt5 import QtGui
-from utils import screen_shooter,now,comment
+from utils import screen_shooter,now,comment,get_experiment_folder
 from stage_controller import stage_controller
 from laser_controller import laser_controller, attenuator_controller
 import time
 import threading
 from PyQt5.QtWidgets import QInputDialog, QLineEdit
-from autofocus import autofocuser
 from localizer import Localizer
-import matplotlib.pyplot as plt
+from video_filters import clahe_filter,temporal_filter
+from camera_capture import camera_capture
+from session_recorder import session_recorder
+from slot_profiler import slot_profiler
+# autofocus (keras and the phidget driver) and matplotlib are imported when first used
 
 class ShowVideo(QtCore.QObject):
 		
 	VideoSignal = QtCore.pyqtSignal(QtGui.QImage)
 	vid_process_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	# the frame with the time it was grabbed, for anything matching frames to other timed events
+	timed_frame_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject')
 	reticle_and_center_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject','PyQt_PyObject','PyQt_PyObject')
 
-	def __init__(self, window_size, parent = None):
+	def __init__(self, window_size, denoise_mode = 'average', record = False, parent = None):
 		super(ShowVideo, self).__init__(parent)
 		self.run_video = True				
 		self.window_size = window_size
 		self.noise_removal = False
+		self.clahe_filter = clahe_filter()
+		# only changes what is displayed, the localizer and screenshots get the raw frames
+		self.temporal_denoise = False
+		self.temporal_filter = temporal_filter(denoise_mode)
 		camera_port = 2 + cv2.CAP_DSHOW
-		self.camera = cv2.VideoCapture(camera_port)
-		self.camera.set(3,1024)#*2) 
-		self.camera.set(4,822)
+		# grabs on its own thread, the localizer and screen shooter also ask it for fresh frames
+		self.capture = camera_capture(camera_port,1024,822)
+		# continuous recording of the raw frames, with an index of what happened on each
+		self.recorder = session_recorder(get_experiment_folder()) if record else None
 		self.center_x = int(1024/2)
 		self.center_y = int(822/2)
 		self.reticle_x = int(self.center_x+6)
@@ -50,24 +61,34 @@ class ShowVideo(QtCore.QObject):
 		comment('video properties:')		
 		for i in range(19):
 			comment('property {}, value: {}'.format(i,
-				self.camera.get(i)))
+				self.capture.camera.get(i)))
+		self.capture.start()
+		if self.recorder is not None: self.recorder.start()
+		frame_time = 0
 		while self.run_video:			
-			ret, image = self.camera.read()
+			# the newest frame, skipping any we were too slow to show
+			frame,new_frame_time = self.capture.get_frame_after(frame_time)
+			if frame is None:
+				comment('no frame from the camera')
+				continue
+			frame_time = new_frame_time
 			# image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
-			self.vid_process_signal.emit(image.copy())			
+			# the frame is shared with everyone else using the capture, so it is only drawn on as a copy
+			self.vid_process_signal.emit(frame)			
+			self.timed_frame_signal.emit(frame,frame_time)
+			if self.recorder is not None: self.recorder.add_frame(frame,frame_time)
 			# print(cv2.Laplacian(image, cv2.CV_64F).var())
+			if self.temporal_denoise == True:
+				image = self.temporal_filter.apply(frame)
+			else:
+				image = frame.copy()
 			self.draw_reticle(image)				
 			if self.noise_removal == True:
 				# print('denoising...')
 				# self.camera.set(3,1024) 
 				# self.camera.set(4,822) 
 				# image = cv2.fastNlMeansDenoisingColored(image,None,3,7,7)
-				lab= cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-				l, a, b = cv2.split(lab)
-				clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-				cl = clahe.apply(l)
-				limg = cv2.merge((cl,a,b))
-				image = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+				image = self.clahe_filter.apply(image)
 				# print('done denoising')
 			color_swapped_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) 			
 			height, width, _ = color_swapped_image.shape 
@@ -78,7 +99,11 @@ class ShowVideo(QtCore.QObject):
 									QtGui.QImage.Format_RGB888) 
 			qt_image = qt_image.scaled(self.window_size)
 			self.VideoSignal.emit(qt_image)		
-		self.camera.release()
+		comment(self.capture.summary())
+		self.capture.stop()
+		if self.recorder is not None:
+			self.recorder.stop()
+			comment(self.recorder.summary())
 		comment('ending video')
 
 class ImageViewer(QtWidgets.QWidget):
@@ -88,11 +113,33 @@ class ImageViewer(QtWidgets.QWidget):
 		super(ImageViewer, self).__init__(parent)
 		self.image = QtGui.QImage()
 		self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+		self.targets = None
+		self.targets_time = 0
+		self.target_display_time = 2
 
 	def paintEvent(self, event):
 		painter = QtGui.QPainter(self)
 		painter.drawImage(0,0, self.image)
+		if self.targets is not None and time.time() - self.targets_time < self.target_display_time:
+			self.draw_targets(painter)
 		self.image = QtGui.QImage()
+
+	def draw_targets(self,painter):
+		# targets are in the pixels of the network output, scale them to the video
+		scale_x = self.image.width()/self.targets_shape[1]
+		scale_y = self.image.height()/self.targets_shape[0]
+		painter.setPen(QtGui.QPen(QtCore.Qt.green,2))
+		for target in self.targets:
+			center = QtCore.QPointF(target['x']*scale_x,target['y']*scale_y)
+			radius = np.sqrt(target['area']/np.pi)
+			painter.drawEllipse(center,radius*scale_x,radius*scale_y)
+			painter.drawText(center,'{:.2f}'.format(target['confidence']))
+
+	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject')
+	def set_targets(self,targets,shape):
+		self.targets = targets
+		self.targets_shape = shape
+		self.targets_time = time.time()
  
 	@QtCore.pyqtSlot(QtGui.QImage)
 	def setImage(self, image):
@@ -110,12 +157,16 @@ class ImageViewer(QtWidgets.QWidget):
 
 class main_window(QMainWindow):
 	start_video_signal = QtCore.pyqtSignal()
+	load_models_signal = QtCore.pyqtSignal()
 	qswitch_screenshot_signal = QtCore.pyqtSignal('PyQt_PyObject')
 	start_focus_signal = QtCore.pyqtSignal()
 	start_localization_signal = QtCore.pyqtSignal()
+	run_plate_signal = QtCore.pyqtSignal('PyQt_PyObject')
 
-	def __init__(self,test_run):
+	def __init__(self,test_run,use_focus_map = False,profiler = None,plate_job_location = None,detector = 'cnn',denoise_mode = 'average',record = False,focus_mode = 'search'):
 		super(main_window, self).__init__()
+		self.profiler = profiler
+		self.plate_job_location = plate_job_location
 		self.lysing = True
 		# get our experiment variables
 		if test_run != 'True':
@@ -126,11 +177,15 @@ class main_window(QMainWindow):
 		self.ui.setupUi(self)	
 
 		# set up the video classes 
-		self.vid = ShowVideo(self.ui.verticalLayoutWidget.size())
+		self.vid = ShowVideo(self.ui.verticalLayoutWidget.size(),denoise_mode,record)
 		self.screen_shooter = screen_shooter()
 		self.image_viewer = ImageViewer()
 		# self.autofocuser = autofocuser()
 		self.localizer = Localizer()		
+		self.localizer.detector_backend = detector
+		# both ask the video's capture for frames grabbed after a given time
+		self.screen_shooter.capture = self.vid.capture
+		self.localizer.capture = self.vid.capture
 
 		# add the viewer to our ui
 		self.ui.verticalLayout.addWidget(self.image_viewer)
@@ -148,6 +203,16 @@ class main_window(QMainWindow):
 		self.localizer_thread.start()
 		self.localizer.moveToThread(self.localizer_thread)
 
+		# all serial traffic to the stage happens on its own thread
+		self.stage_thread = QThread()
+		self.stage_thread.start()
+		stage.moveToThread(self.stage_thread)
+
+		# bursts are timed on the laser's own thread so they don't freeze the GUI
+		self.laser_thread = QThread()
+		self.laser_thread.start()
+		laser.moveToThread(self.laser_thread)
+
 		self.video_input_thread = QThread()
 		self.video_input_thread.start()
 		self.vid.moveToThread(self.video_input_thread)
@@ -157,18 +222,30 @@ class main_window(QMainWindow):
 		self.vid.vid_process_signal.connect(self.screen_shooter.screenshot_slot)		
 		# self.vid.vid_process_signal.connect(self.autofocuser.vid_process_slot)
 		self.vid.vid_process_signal.connect(self.localizer.vid_process_slot)
+		self.vid.vid_process_signal.connect(stage.vid_process_slot,QtCore.Qt.DirectConnection)
 		self.qswitch_screenshot_signal.connect(self.screen_shooter.save_qswitch_fire_slot)
 		self.localizer.qswitch_screenshot_signal.connect(self.screen_shooter.save_qswitch_fire_slot)
 		# self.start_focus_signal.connect(self.autofocuser.autofocus)
 		self.start_localization_signal.connect(self.localizer.localize)
+		self.run_plate_signal.connect(self.localizer.run_plate)
 		# self.autofocuser.position_and_variance_signal.connect(self.plot_variance_and_position)
 		self.image_viewer.click_move_signal.connect(stage.click_move_slot)
 		self.localizer.localizer_move_signal.connect(stage.localizer_move_slot)
 		self.localizer.ai_fire_qswitch_signal.connect(self.ai_fire_qswitch_slot)
+		self.localizer.fire_burst_signal.connect(laser.fire_burst_slot)
+		laser.burst_complete_signal.connect(self.localizer.burst_return_slot)
 		self.localizer.start_laser_flash_signal.connect(self.start_laser_flash_slot)
 		self.localizer.stop_laser_flash_signal.connect(self.stop_laser_flash_slot)
+		self.localizer.targets_signal.connect(self.image_viewer.set_targets)
 		self.vid.reticle_and_center_signal.connect(stage.reticle_and_center_slot)
 		self.vid.reticle_and_center_signal.emit(self.vid.center_x,self.vid.center_y,self.vid.reticle_x,self.vid.reticle_y)
+		if use_focus_map == True:
+			self.setup_focus_map(focus_mode)
+		if self.profiler is not None:
+			self.profiler.track_signal(self.vid.vid_process_signal,screen_shooter,'screenshot_slot')
+			self.profiler.track_signal(self.vid.vid_process_signal,Localizer,'vid_process_slot')
+			self.profiler.track_signal(self.localizer.localizer_move_signal,stage_controller,'localizer_move_slot')
+			self.profiler.track_signal(self.localizer.ai_fire_qswitch_signal,main_window,'ai_fire_qswitch_slot')
 
 		# connect to the video thread and start the video
 		self.start_video_signal.connect(self.vid.startVideo)
@@ -178,6 +255,7 @@ class main_window(QMainWindow):
 		self.ui.misc_screenshot_button.clicked.connect(self.screen_shooter.save_misc_image)
 		self.ui.user_comment_button.clicked.connect(self.send_user_comment)
 		self.ui.noise_filter_checkbox.stateChanged.connect(self.noise_filter_check_changed)
+		self.ui.temporal_filter_checkbox.stateChanged.connect(self.temporal_filter_check_changed)
 
 		# Stage movement buttons
 		self.ui.step_size_doublespin_box.valueChanged.connect(stage.set_step_size)
@@ -191,8 +269,34 @@ class main_window(QMainWindow):
 
 		self.ui.cells_to_lyse_doublespin_box.valueChanged.connect(self.localizer.set_cells_to_lyse)
 		self.ui.process_well_pushButton.clicked.connect(self.start_localization)
+
+		# the localizer model loads on the localizer thread once the window is up
+		self.localizer.model_status_signal.connect(self.model_status_slot)
+		self.load_models_signal.connect(self.localizer.load_models_slot)
+		self.model_status_slot(False,'loading localizer model...')
 		self.show()		
-		comment('finished gui init')	
+		comment('finished gui init, {:.2f}s since start'.format(time.time() - startup_time))	
+		self.load_models_signal.emit()
+
+	def setup_focus_map(self,focus_mode = 'search'):
+		'''
+		brings up the autofocuser so the localizer can measure a focus map
+		at the start of each well instead of focusing on every tile
+		'''
+		from autofocus import autofocuser
+		self.autofocuser = autofocuser()
+		self.autofocuser.focus_mode = focus_mode
+		self.autofocuser_thread = QThread()
+		self.autofocuser_thread.start()
+		self.autofocuser.moveToThread(self.autofocuser_thread)
+		# focus sweeps match frames to stepper positions by grab time
+		self.vid.timed_frame_signal.connect(self.autofocuser.timed_frame_slot)
+		self.start_focus_signal.connect(self.autofocuser.autofocus)
+		self.localizer.autofocus_signal.connect(self.autofocuser.autofocus)
+		self.localizer.focus_move_signal.connect(self.autofocuser.focus_move_slot)
+		self.autofocuser.focus_move_done_signal.connect(self.localizer.focus_move_done_slot)
+		self.autofocuser.focused_position_signal.connect(self.localizer.focus_return_slot)
+		self.localizer.use_focus_map = True
 
 	def get_text(self,text_prompt):
 		text, okPressed = QInputDialog.getText(self, "Experiment Input",text_prompt, QLineEdit.Normal, "")
@@ -217,8 +321,19 @@ class main_window(QMainWindow):
 	def start_autofocus(self):
 		self.start_focus_signal.emit()
 
+	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject')
+	def model_status_slot(self,ready,message):
+		self.ui.process_well_pushButton.setEnabled(ready)
+		self.statusBar().showMessage(message)
+		if ready:
+			comment('{}, {:.2f}s since start'.format(message,time.time() - startup_time))
+
 	def start_localization(self):
-		self.start_localization_signal.emit()
+		# with a plate job the button runs every remaining well of the plate
+		if self.plate_job_location is not None:
+			self.run_plate_signal.emit(self.plate_job_location)
+		else:
+			self.start_localization_signal.emit()
 
 	def noise_filter_check_changed(self,int):
 		if self.ui.noise_filter_checkbox.isChecked():
@@ -226,6 +341,14 @@ class main_window(QMainWindow):
 		else:
 			self.vid.noise_removal = False
 
+	def temporal_filter_check_changed(self,int):
+		if self.ui.temporal_filter_checkbox.isChecked():
+			self.vid.temporal_filter.reset()
+			self.vid.temporal_denoise = True
+		else:
+			self.vid.temporal_denoise = False
+			comment(self.vid.temporal_filter.summary())
+
 	def setup_combobox(self):
 		magnifications = [
 		'4x',
@@ -247,9 +370,12 @@ class main_window(QMainWindow):
 	@QtCore.pyqtSlot()
 	def qswitch_screenshot_slot(self):
 		self.qswitch_screenshot_signal.emit(15)
-		comment('stage position during qswitch: {}'.format(stage.get_position_slot()))
+		stage.queue_command(self.log_qswitch_position)
 		laser.fire_qswitch()		
 	
+	def log_qswitch_position(self):
+		comment('stage position during qswitch: {}'.format(stage.get_position_slot()))
+
 	@QtCore.pyqtSlot('PyQt_PyObject')
 	def ai_fire_qswitch_slot(self,auto_fire):
 		comment('automated firing from localizer!')
@@ -282,11 +408,11 @@ class main_window(QMainWindow):
 		if not event.isAutoRepeat():
 			print('key pressed {}'.format(event.key()))
 			key_control_dict = {
-			87:stage.move_up,
-			65:stage.move_left,
-			83:stage.move_down,
-			68:stage.move_right,
-			66:stage.move_last,
+			87:stage.jog_up,
+			65:stage.jog_left,
+			83:stage.jog_down,
+			68:stage.jog_right,
+			66:lambda: stage.queue_command(stage.move_last),
 			16777249:laser.fire_auto,
 			70:self.qswitch_screenshot_slot,
 			81:laser.qswitch_auto,
@@ -294,9 +420,10 @@ class main_window(QMainWindow):
 			# 75:self.autofocuser.roll_backward,
 			# 79:self.start_autofocus,
 			# 71:self.toggle_dmf_or_lysis,
-			84:stage.move_left_one_well_slot,
-			89:stage.move_right_one_well_slot,
+			84:lambda: stage.queue_command(stage.move_left_one_well_slot),
+			89:lambda: stage.queue_command(stage.move_right_one_well_slot),
 			96:self.screen_shooter.save_target_image,
+			67:lambda: stage.queue_command(stage.calibrate),
 			16777216:self.localizer.stop_auto_lysis
 			}
 			if event.key() in key_control_dict.keys():
@@ -315,9 +442,18 @@ class main_window(QMainWindow):
 
 	def closeEvent(self, event):
 		self.vid.run_video = False	
+		# let startVideo finish, so the capture is released and the recording finalized before we exit
+		self.video_input_thread.quit()
+		if not self.video_input_thread.wait(5000):
+			comment('video thread did not finish, the session recording may be incomplete')
+		comment('stage command queue stats: {}'.format(stage.get_queue_stats()))
+		comment(self.vid.temporal_filter.summary())
+		if self.profiler is not None:
+			self.profiler.report(get_experiment_folder())
 
 	@QtCore.pyqtSlot('PyQt_PyObject')
 	def plot_variance_and_position(self,ituple):
+		import matplotlib.pyplot as plt
 		positions = ituple[0]
 		variances = ituple[1]
 		plt.plot(positions)
@@ -330,11 +466,37 @@ class main_window(QMainWindow):
 if __name__ == '__main__':	
 	parser = argparse.ArgumentParser()
 	parser.add_argument('test_run')
+	parser.add_argument('--focus_map',action = 'store_true',
+		help = 'measure a focus map per well and follow it during the scan')
+	parser.add_argument('--focus_mode',choices = ['search','sweep','cnn_sweep'],default = 'search',
+		help = 'how the focus map points are focused, stepping between positions or scoring the frames of one continuous sweep, cnn_sweep scores them with the focus network')
+	parser.add_argument('--profile',nargs = '?',const = 'timing',default = os.environ.get('LCL_PROFILE'),
+		help = 'time the hot Qt slots and report at exit, use "cprofile" to also profile each thread. can also be set with LCL_PROFILE')
+	parser.add_argument('--plate',
+		help = 'plate job file, the process well button then runs every well of the plate that is not done yet')
+	parser.add_argument('--detector',choices = ['cnn','hough'],default = 'cnn',
+		help = 'find cells with the localizer network or the classical hough circle detector')
+	parser.add_argument('--denoise_mode',choices = ['average','median'],default = 'average',
+		help = 'how the denoise checkbox combines frames, a running average or the median of the last 5')
+	parser.add_argument('--record',action = 'store_true',
+		help = 'record the whole session to a compressed video in the experiment folder, with an index of qswitch fires, stage moves and comments')
 	args = parser.parse_args()
+	comment('imports finished, {:.2f}s since start'.format(time.time() - startup_time))
+	profiler = None
+	if args.profile:
+		# slots are wrapped on their classes before anything gets connected
+		profiler = slot_profiler(use_cprofile = args.profile == 'cprofile')
+		profiler.wrap_slot(screen_shooter,'screenshot_slot')
+		profiler.wrap_slot(Localizer,'vid_process_slot')
+		profiler.wrap_slot(stage_controller,'localizer_move_slot')
+		profiler.wrap_slot(main_window,'ai_fire_qswitch_slot')
+		comment('slot profiling enabled: {}'.format(args.profile))
 	app = QApplication(sys.argv)
 	stage = stage_controller()
+	comment('stage connected, {:.2f}s since start'.format(time.time() - startup_time))
 	attenuator = attenuator_controller()
 	laser = laser_controller()	
-	window = main_window(args.test_run)	
+	comment('laser and attenuator connected, {:.2f}s since start'.format(time.time() - startup_time))
+	window = main_window(args.test_run,args.focus_map,profiler,args.plate,args.detector,args.denoise_mode,args.record,args.focus_mode)	
 	comment('exit with code: ' + str(app.exec_()))
 	
\ No newline at end of file
@@ -89,6 +89,9 @@ class Ui_MainWindow(object):
         self.noise_filter_checkbox = QtWidgets.QCheckBox(self.centralwidget)
         self.noise_filter_checkbox.setGeometry(QtCore.QRect(70, 140, 71, 17))
         self.noise_filter_checkbox.setObjectName("noise_filter_checkbox")
+        self.temporal_filter_checkbox = QtWidgets.QCheckBox(self.centralwidget)
+        self.temporal_filter_checkbox.setGeometry(QtCore.QRect(85, 192, 55, 17))
+        self.temporal_filter_checkbox.setObjectName("temporal_filter_checkbox")
         self.automation_groupbox = QtWidgets.QGroupBox(self.centralwidget)
         self.automation_groupbox.setGeometry(QtCore.QRect(10, 360, 120, 251))
         self.automation_groupbox.setObjectName("automation_groupbox")
@@ -138,6 +141,7 @@ class Ui_MainWindow(object):
         self.attenuator_label.setText(_translate("MainWindow", "Attenuator"))
         self.step_size_label.setText(_translate("MainWindow", "Stage Step Size"))
         self.noise_filter_checkbox.setText(_translate("MainWindow", "CLAHE"))
+        self.temporal_filter_checkbox.setText(_translate("MainWindow", "Denoise"))
         self.automation_groupbox.setTitle(_translate("MainWindow", "Automation"))
         self.cells_to_lyse_label.setText(_translate("MainWindow", "Cells to Lyse"))
         self.process_well_pushButton.setText(_translate("MainWindow", "Process Well"))
@@ -11,7 +11,8 @@ from multiprocessing.pool import ThreadPool
 import numpy as np
 import os
 from utils import now
-from keras.models import load_model
+from focus_metrics import get_focus_scores,match_scores_to_positions
+from model_cache import load_cached_model
 import tensorflow as tf
 global graph
 graph = tf.get_default_graph()
@@ -26,6 +27,8 @@ class autofocuser(QtCore.QObject):
 	'''
 	# TODO implement a property that prevents the motor from ever going outside of its range. 
 	position_and_variance_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	focused_position_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	focus_move_done_signal = QtCore.pyqtSignal('PyQt_PyObject')
 	def __init__(self, parent = None):
 		super(autofocuser, self).__init__(parent)
 		self.ch = Stepper()
@@ -34,6 +37,11 @@ class autofocuser(QtCore.QObject):
 		self.full_scale = 27300
 		self.image_count = 0
 		self.track_position = False
+		self.position_log = []
+		self.score_frames = False
+		self.focus_log = []
+		self.buffer_frames = False
+		self.frame_buffer = []
 		self.pool = ThreadPool(processes=3)
 		self.velocity = 0
 		self.ch.setDataInterval(100)
@@ -58,9 +66,14 @@ class autofocuser(QtCore.QObject):
 		self.ch.setOnVelocityChangeHandler(self.velocity_change_handler)
 		self.ch.setOnPositionChangeHandler(self.position_change_handler)
 		self.image_title = 0
-		self.focus_model = load_model(os.path.join(experiment_folder_location,'VGG_model_5.hdf5'))
+		self.focus_model,_ = load_cached_model(os.path.join(experiment_folder_location,'VGG_model_5.hdf5'))
 		self.focus_model._make_predict_function()
 		self.belt_slip_offset = 120
+		self.steps_travelled = 0
+		# 'search' steps between positions, 'sweep' scores the frames of one continuous sweep
+		# with the variance of laplacian and 'cnn_sweep' with one batched pass of the focus network
+		self.focus_mode = 'search'
+		self.sweep_range = 4000
 		# self.step_to_position(self.full_scale)
 		# self.autofocus()
 
@@ -71,12 +84,25 @@ class autofocuser(QtCore.QObject):
 	def position_change_handler(self,self2,position):
 		# print('POSITION CHANGED:',position)
 		self.position = position
+		if self.track_position: self.position_log.append((time.time(),position))
 
 	@QtCore.pyqtSlot('PyQt_PyObject')
 	def vid_process_slot(self,image):
+		# without a grab time the best we have is when the frame got here
+		self.timed_frame_slot(image,time.time())
+
+	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject')
+	def timed_frame_slot(self,image,frame_time):
+		'''
+		frame_time is when the camera grabbed the frame, so the signal delay
+		doesn't show up as a position error when frames are matched to the
+		stepper position log
+		'''
 		self.image = image
 		# print(image.shape)
 		self.image_count += 1
+		if self.score_frames: self.focus_log.append((frame_time,get_focus_scores(image)))
+		if self.buffer_frames: self.frame_buffer.append((frame_time,self.preprocess_for_network(image)))
 		# print('image received in autofocus')
 
 	def get_position(self):
@@ -90,6 +116,7 @@ class autofocuser(QtCore.QObject):
 		# TODO check if the given position will make us exceed the range		
 		self.ch.setTargetPosition(self.position + position)
 		self.position += position
+		self.steps_travelled += abs(position)
 
 	def roll_forward(self):
 		self.ch.setControlMode(1)
@@ -120,42 +147,130 @@ class autofocuser(QtCore.QObject):
 	def return_objective_to_focus(self):
 		self.ch.setTargetPosition(self.focused_position)
 
-	def get_network_output(self,img):
+	def preprocess_for_network(self,img):
 		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 		img = cv2.resize(img, (100, 100))
-		img = np.expand_dims(img,axis = 4) 
+		return np.expand_dims(img,axis = -1)
+
+	def get_network_output(self,img):
+		img = self.preprocess_for_network(img)
 		img = np.expand_dims(img,axis = 0) 
 		with graph.as_default():
 			prediction = self.focus_model.predict(img,batch_size = 1)[0][0]
 			print('focus metric:',prediction)
 		return prediction
 
+	def wait_for_stop(self):
+		while self.ch.getIsMoving() == True:
+			QApplication.processEvents()
+			time.sleep(.01)
+
+	def step_to_position(self,position):
+		'''
+		moves to an absolute position, always finishing with a move in the
+		positive direction so that belt slip is taken up the same way each time
+		'''
+		if position < self.position:
+			self.step_to_relative_position(position - self.position - self.belt_slip_offset)
+			self.wait_for_stop()
+		self.step_to_relative_position(position - self.position)
+		self.wait_for_stop()
+
+	def get_fresh_image(self,frames_to_skip = 2,timeout = 2):
+		'''
+		waits for frames captured after the call so that the image we score
+		was taken at the current objective position
+		'''
+		start_count = self.image_count
+		start_time = time.time()
+		while self.image_count < start_count + frames_to_skip:
+			QApplication.processEvents()
+			if time.time() - start_time > timeout:
+				comment('timed out waiting for a fresh autofocus frame')
+				break
+			time.sleep(.005)
+		return self.image
+
+	def score_position(self,position,scores):
+		position = int(np.rint(position))
+		if position not in scores:
+			self.step_to_position(position)
+			scores[position] = self.get_network_output(self.get_fresh_image())
+		return scores[position]
+
 	@QtCore.pyqtSlot()
 	def autofocus(self):
-		positions_to_check = 40
-		steps_between_positions = 100
+		if self.focus_mode in ('sweep','cnn_sweep'):
+			self.sweep_autofocus()
+		else:
+			self.search_autofocus()
+
+	def search_autofocus(self):
+		'''
+		coarse sweep in the positive direction until we pass the peak of the
+		focus score, then a golden section search around the best coarse
+		position. scores are cached by position so no position is imaged twice
+		'''
+		start_time = time.time()
+		start_steps = self.steps_travelled
+		coarse_positions = 9
+		coarse_step = 500
+		tolerance = 25
 		threshold = .75
-		num_good_scores = 0
-		for i in range(positions_to_check):
-			QApplication.processEvents() 
-			self.step_to_relative_position(steps_between_positions)
-			score = self.get_network_output(self.image)
-			if score > threshold: num_good_scores += 1
-			if num_good_scores > 2: break			
-		self.step_to_relative_position(-2*steps_between_positions-self.belt_slip_offset)
-		# now verify that it is focused
-		QApplication.processEvents() 
-		# time.sleep(1)
-		# QApplication.processEvents() 
-		# print('checking focus...')
-		# score = self.get_network_output(self.image)
-		# i = 0
-		# while score < threshold:
-		# 	i += 1
-		# 	self.step_to_relative_position(-steps_between_positions)
-		# 	QApplication.processEvents() 
-		# 	score = self.get_network_output(self.image)
-		# 	if i > 4: break
+		scores = {}
+		start = int(self.position)
+		best = start
+		for i in range(coarse_positions):
+			position = start + i*coarse_step
+			score = self.score_position(position,scores)
+			if score > scores[best]: best = position
+			# once we have seen a good score and dropped well below it we are past focus
+			if scores[best] > threshold and score < scores[best]/2: break
+		comment('autofocus coarse sweep: best score {} at {} after {} evaluations'.format(
+			scores[best],best,len(scores)))
+		low,high = best - coarse_step, best + coarse_step
+		inv_phi = (np.sqrt(5) - 1)/2
+		c = high - inv_phi*(high - low)
+		d = low + inv_phi*(high - low)
+		while high - low > tolerance:
+			if self.score_position(c,scores) > self.score_position(d,scores):
+				high = d
+			else:
+				low = c
+			c = high - inv_phi*(high - low)
+			d = low + inv_phi*(high - low)
+		self.focused_position = max(scores,key = scores.get)
+		self.step_to_position(self.focused_position)
+		comment('autofocus: focused at {} (score {}) with {} evaluations, {} steps travelled, {:.2f}s'.format(
+			self.focused_position,scores[self.focused_position],len(scores),
+			self.steps_travelled - start_steps,time.time() - start_time))
+		self.focused_position_signal.emit(self.focused_position)
+
+	def sweep_autofocus(self):
+		'''
+		one constant velocity sweep in the positive direction over about the
+		range the coarse search covers, then a move to the sharpest frame
+		'''
+		start_time = time.time()
+		start_steps = self.steps_travelled
+		if self.focus_mode == 'cnn_sweep':
+			result = self.cnn_focus_over_range(self.sweep_range)
+		else:
+			result = self.focus_over_range(self.sweep_range)
+		if result is None:
+			comment('focus sweep scored no frames, using the step search')
+			return self.search_autofocus()
+		score,self.focused_position,_ = result
+		self.step_to_position(self.focused_position)
+		comment('autofocus sweep: focused at {} (score {}), {} steps travelled, {:.2f}s'.format(
+			self.focused_position,score,self.steps_travelled - start_steps,time.time() - start_time))
+		self.focused_position_signal.emit(self.focused_position)
+
+	@QtCore.pyqtSlot('PyQt_PyObject')
+	def focus_move_slot(self,position):
+		self.step_to_position(position)
+		# step_to_position waits for the stepper to stop
+		self.focus_move_done_signal.emit(self.position)
 
 
 
@@ -205,42 +320,76 @@ class autofocuser(QtCore.QObject):
 		# while self.ch.getIsMoving() == True:
 		# 	time.sleep(.1)		
 
-	def focus_over_range(self,range):
-		self.pool.apply_async(self.step_to_relative_position(range))		
-		variances = []
-		positions = []
-		old_position = 0
-		self.image_title += 1
+	def sweep_over_range(self,range,velocity = 2000):
+		'''
+		moves the objective over a range at constant velocity, logging the
+		stepper position events with timestamps as it goes
+		'''
+		self.position_log = [(time.time(),self.position)]
+		self.track_position = True
+		# report positions as often as the stepper allows during the sweep
+		self.ch.setDataInterval(self.ch.getMinDataInterval())
 		self.ch.setAcceleration(15000)
-		self.ch.setVelocityLimit(2000)
-		while self.ch.getIsMoving() == True:
-			QApplication.processEvents() 
-			new_position = self.position
-			if old_position != new_position: positions.append(self.position)
-			old_position = new_position
-			# we want to focus on what's towards the center of our image
-			h,w = self.image.shape[0],self.image.shape[1]
-			img = self.image[int(.25*h):int(.75*h),int(.25*w):int(.75*w)]
-			variance = cv2.Laplacian(img, cv2.CV_64F).var()
-
-			variances.append(variance)		
-			# print(os.path.join(experiment_folder_location,
-			# 	'{}___{}.tif'.format(self.image_title,now())))
-			# cv2.imwrite(os.path.join(experiment_folder_location,
-			# 	'{}___{}.tif'.format(self.image_title,now())),self.image)	
-		unit_scaled_location_of_highest_variance = variances.index(max(variances))/len(variances)
-		print('location of highest variance: {}'.format(unit_scaled_location_of_highest_variance))
-		closest_position = int(np.rint(len(positions)*unit_scaled_location_of_highest_variance))-1
-		print('closest_position',closest_position)
-		print('max variance of {} occurred at location {}'.format(
-			max(variances),positions[closest_position]))
-		# self.ch.setTargetPosition(positions[closest_position])
-		# self.position_and_variance_signal.emit((positions,variances))
+		self.ch.setVelocityLimit(velocity)
+		self.ch.setTargetPosition(self.position + range)
+		self.steps_travelled += abs(range)
 		while self.ch.getIsMoving() == True:
-			time.sleep(.1)		
-		
+			QApplication.processEvents()
+			time.sleep(.001)
+		QApplication.processEvents()
+		self.track_position = False
+		self.ch.setDataInterval(100)
+		self.position_log.append((time.time(),self.get_position()))
 
-		return max(variances),positions[closest_position],variances
+	def get_positions_at(self,times):
+		position_times,positions = zip(*self.position_log)
+		return match_scores_to_positions(np.array(times),
+			np.array(position_times),np.array(positions))
+
+	def focus_over_range(self,range,metric = 'variance of laplacian'):
+		'''
+		scores every incoming frame during a sweep, then matches each score
+		to the stepper position at the time the frame was grabbed
+		'''
+		self.focus_log = []
+		self.score_frames = True
+		self.sweep_over_range(range)
+		self.score_frames = False
+		if len(self.focus_log) == 0:
+			comment('no frames were scored during the focus sweep')
+			return None
+		scores = np.array([score[metric] for _,score in self.focus_log])
+		matched_positions = self.get_positions_at([score_time for score_time,_ in self.focus_log])
+		self.focus_curve = (matched_positions,self.focus_log)
+		best = int(np.argmax(scores))
+		comment('max {} of {} occurred at location {} ({} frames scored)'.format(
+			metric,scores[best],int(matched_positions[best]),len(scores)))
+		return scores[best],int(matched_positions[best]),scores.tolist()
+
+	def cnn_focus_over_range(self,range,batch_size = 64):
+		'''
+		buffers downscaled frames during a sweep and scores them with the
+		focus network in a single batched predict once the sweep is done
+		'''
+		self.frame_buffer = []
+		self.buffer_frames = True
+		self.sweep_over_range(range)
+		self.buffer_frames = False
+		if len(self.frame_buffer) == 0:
+			comment('no frames were buffered during the focus sweep')
+			return None
+		frame_times = [frame_time for frame_time,_ in self.frame_buffer]
+		frames = np.stack([frame for _,frame in self.frame_buffer])
+		start_time = time.time()
+		with graph.as_default():
+			scores = self.focus_model.predict(frames,batch_size = batch_size)[:,0]
+		comment('scored {} frames in {:.3f}s'.format(len(scores),time.time() - start_time))
+		matched_positions = self.get_positions_at(frame_times)
+		self.focus_curve = (matched_positions,scores)
+		best = int(np.argmax(scores))
+		comment('max network focus metric of {} occurred at location {}'.format(
+			scores[best],int(matched_positions[best])))
+		return scores[best],int(matched_positions[best]),scores.tolist()
 
 experiment_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
 print(experiment_folder_location)
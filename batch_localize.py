@@ -0,0 +1,124 @@
+'''
+runs the localizer pipeline headless over stored images, e.g. to re-score
+old experiments after a model changes:
+
+	python batch_localize.py Experiments --cell_type red --output rescored
+
+preprocessing and target extraction run in a process pool while the model
+predicts whole batches in this process. each image gets a csv table of its
+targets under --output, mirroring where it came from, and images that
+already have a table are skipped so an interrupted run can be restarted
+'''
+import os,csv,time,fnmatch,argparse,multiprocessing
+import numpy as np
+import cv2
+from localizer_pipeline import get_network_mode,preprocess_for_network,postprocess_network_output,threshold_based_on_type
+from target_extraction import extract_targets,get_probability_image
+
+models_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
+target_table_columns = ['label','x','y','area','bbox_x','bbox_y','bbox_w','bbox_h','confidence','class']
+
+def find_images(inputs,pattern):
+	# yields images as they are found so a run over months of data starts straight away
+	for input_location in inputs:
+		if os.path.isfile(input_location):
+			yield input_location,os.path.dirname(input_location)
+			continue
+		for folder,_,file_names in os.walk(input_location):
+			for file_name in sorted(fnmatch.filter(file_names,pattern)):
+				yield os.path.join(folder,file_name),input_location
+
+def get_table_location(output_location,image_location,root):
+	relative = os.path.relpath(image_location,root)
+	return os.path.join(output_location,os.path.basename(os.path.abspath(root)),relative + '.targets.csv')
+
+def init_worker():
+	global norm
+	from sklearn.preprocessing import StandardScaler
+	norm = StandardScaler()
+
+def load_and_preprocess(image_location):
+	img = cv2.imread(image_location)
+	if img is None: return None
+	return preprocess_for_network(img,norm)[0]
+
+def extract_image_targets(args):
+	network_output,cell_type,min_area = args
+	segmented_image = postprocess_network_output(network_output[np.newaxis],get_network_mode(cell_type))
+	confidence_image = threshold_based_on_type(segmented_image,cell_type)
+	targets,_ = extract_targets(confidence_image,get_probability_image(segmented_image,cell_type),
+		cell_type,min_area)
+	return targets
+
+def write_target_table(table_location,targets):
+	os.makedirs(os.path.dirname(table_location),exist_ok = True)
+	with open(table_location + '.tmp','w',newline = '') as f:
+		writer = csv.writer(f)
+		writer.writerow(target_table_columns)
+		for target in targets:
+			writer.writerow([target['label'],'{:.2f}'.format(target['x']),'{:.2f}'.format(target['y']),
+				target['area']] + list(target['bbox']) + ['{:.4f}'.format(target['confidence']),target['class']])
+	os.replace(table_location + '.tmp',table_location)
+
+def get_batches(images,batch_size):
+	batch = []
+	for image in images:
+		batch.append(image)
+		if len(batch) == batch_size:
+			yield batch
+			batch = []
+	if len(batch) > 0: yield batch
+
+def run_batch_localization(args):
+	from model_cache import load_cached_model
+	images = ((image_location,get_table_location(args.output,image_location,root))
+		for image_location,root in find_images(args.inputs,args.pattern))
+	if not args.overwrite:
+		images = (image for image in images if not os.path.exists(image[1]))
+	start_time = time.time()
+	image_count,target_count,unreadable = 0,0,0
+	predict_time = 0
+	# the workers are started before tensorflow is loaded so they don't inherit it
+	with multiprocessing.Pool(args.workers,initializer = init_worker) as pool:
+		model,_ = load_cached_model(os.path.join(models_folder_location,args.model),compile = False)
+		batches = get_batches(images,args.batch_size)
+		batch = next(batches,None)
+		pending = pool.map_async(load_and_preprocess,[image[0] for image in batch]) if batch else None
+		while batch is not None:
+			inputs = pending.get()
+			# preprocess the next batch while this one is predicted
+			next_batch = next(batches,None)
+			if next_batch is not None:
+				pending = pool.map_async(load_and_preprocess,[image[0] for image in next_batch])
+			readable = [i for i,network_input in enumerate(inputs) if network_input is not None]
+			unreadable += len(batch) - len(readable)
+			if len(readable) > 0:
+				predict_start = time.time()
+				outputs = model.predict(np.stack([inputs[i] for i in readable]),batch_size = args.batch_size)
+				predict_time += time.time() - predict_start
+				all_targets = pool.map(extract_image_targets,
+					[(output,args.cell_type,args.min_area) for output in outputs])
+				for i,targets in zip(readable,all_targets):
+					write_target_table(batch[i][1],targets)
+					target_count += len(targets)
+				image_count += len(readable)
+			elapsed = time.time() - start_time
+			print('{} images, {} targets, {:.1f} images/s'.format(image_count,target_count,image_count/max(elapsed,1e-9)))
+			batch = next_batch
+	elapsed = time.time() - start_time
+	print('finished {} images ({} unreadable) in {:.1f}s, {:.1f} images/s, {:.1f}s of it predicting'.format(
+		image_count,unreadable,elapsed,image_count/max(elapsed,1e-9),predict_time))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'run the localizer over stored images without the GUI or hardware')
+	parser.add_argument('inputs',nargs = '*',default = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'Experiments')],
+		help = 'image files or folders to search, defaults to the Experiments folder')
+	parser.add_argument('--model',default = 'model2018-10-18_08_47',help = 'model file in models/')
+	parser.add_argument('--cell_type',default = 'red',choices = ['red','green','green hope'])
+	parser.add_argument('--output',default = 'batch_localization',help = 'folder to write the target tables to')
+	parser.add_argument('--pattern',default = '*.tif')
+	parser.add_argument('--batch_size',type = int,default = 32)
+	parser.add_argument('--workers',type = int,default = max(multiprocessing.cpu_count() - 1,1))
+	parser.add_argument('--min_area',type = int,default = 20)
+	parser.add_argument('--overwrite',action = 'store_true',help = 'redo images that already have a target table')
+	run_batch_localization(parser.parse_args())
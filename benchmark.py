@@ -0,0 +1,240 @@
+'''
+micro-benchmarks for the image processing and control hot paths, run on
+the frames stored in models/. results are written as json, tagged with the
+current commit, so runs from different commits can be compared:
+
+	python benchmark.py --output before.json
+	python benchmark.py --output after.json --compare before.json
+
+benchmarks whose dependencies or model files are missing are recorded as skipped.
+note that the utils.comment benchmark creates an experiment folder like the GUI does
+'''
+import os,sys,io,time,json,glob,argparse,subprocess,platform,itertools,contextlib
+from types import SimpleNamespace
+import numpy as np
+import cv2
+
+models_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
+
+def load_frames():
+	paths = sorted(glob.glob(os.path.join(models_folder_location,'*.tif')))
+	frames = [cv2.imread(path) for path in paths]
+	return [frame for frame in frames if frame is not None]
+
+def get_commit():
+	try:
+		return subprocess.check_output(['git','rev-parse','HEAD'],
+			cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+	except (OSError,subprocess.CalledProcessError):
+		return 'unknown'
+
+def time_function(function,repeats,warmup = 3):
+	for i in range(warmup): function()
+	times = []
+	for i in range(repeats):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - start)
+	times = np.array(times)*1000
+	return {'repeats':repeats,
+		'mean ms':float(np.mean(times)),
+		'median ms':float(np.median(times)),
+		'min ms':float(np.min(times)),
+		'p90 ms':float(np.percentile(times,90))}
+
+class fake_serial():
+	'''
+	stands in for a serial port, handing back a canned response one read
+	at a time and starting over once it has all been read
+	'''
+	def __init__(self,response):
+		self.response = response
+		self.index = 0
+
+	def read(self,size = 1):
+		piece = self.response[self.index:self.index + size]
+		self.index += size
+		if self.index >= len(self.response): self.index = 0
+		return piece
+
+	def write(self,data):
+		return len(data)
+
+def fake_network_output(frame):
+	# a smooth 128x128x3 probability map with the structure of a real frame
+	gray = cv2.resize(cv2.cvtColor(frame,cv2.COLOR_BGR2GRAY),(128,128)).astype(np.float64)
+	gray = (gray - gray.min())/max(gray.max() - gray.min(),1)
+	return np.stack([1 - gray,gray,gray],axis = -1)[np.newaxis]
+
+def quiet(function):
+	# comment() prints every call, keep that off the terminal while timing
+	def wrapped():
+		with contextlib.redirect_stdout(io.StringIO()):
+			return function()
+	return wrapped
+
+def setup_network_preprocessing(frames):
+	from localizer_pipeline import preprocess_for_network
+	from sklearn.preprocessing import StandardScaler
+	norm = StandardScaler()
+	frame_cycle = itertools.cycle(frames)
+	return lambda: preprocess_for_network(next(frame_cycle),norm)
+
+def setup_network_postprocessing(frames):
+	from localizer_pipeline import postprocess_network_output
+	outputs = itertools.cycle([fake_network_output(frame) for frame in frames])
+	return lambda: postprocess_network_output(next(outputs),'multi')
+
+def setup_threshold_based_on_type(frames):
+	from localizer_pipeline import postprocess_network_output,threshold_based_on_type
+	images = itertools.cycle([postprocess_network_output(fake_network_output(frame),'multi') for frame in frames])
+	return lambda: threshold_based_on_type(next(images),'red')
+
+def setup_extract_targets(frames):
+	from localizer_pipeline import postprocess_network_output,threshold_based_on_type
+	from target_extraction import extract_targets,get_probability_image
+	outputs = [postprocess_network_output(fake_network_output(frame),'multi') for frame in frames]
+	images = itertools.cycle([(threshold_based_on_type(output,'red'),get_probability_image(output,'red'))
+		for output in outputs])
+	return lambda: extract_targets(*next(images))
+
+def setup_stitch_img(frames):
+	from localizer import wellStitcher
+	stitcher = wellStitcher(1,frames[0],tile_step = (800,650))
+	grid_positions = itertools.cycle([(x,y) for y in range(3) for x in range(3)])
+	frame_cycle = itertools.cycle(frames)
+	return lambda: stitcher.stitch_img(next(frame_cycle),next(grid_positions))
+
+def setup_clahe(frames):
+	from video_filters import clahe_filter
+	clahe = clahe_filter()
+	frame_cycle = itertools.cycle(frames)
+	return lambda: clahe.apply(next(frame_cycle))
+
+def setup_temporal_filter(mode):
+	def setup(frames):
+		from video_filters import temporal_filter
+		denoiser = temporal_filter(mode)
+		# the same frame with fresh noise each time, so the filter never sees motion
+		random_state = np.random.RandomState(0)
+		noisy_frames = itertools.cycle([cv2.add(frames[0],random_state.randint(0,8,frames[0].shape,dtype = np.uint8))
+			for i in range(10)])
+		return lambda: denoiser.apply(next(noisy_frames))
+	return setup
+
+def setup_comment(frames):
+	from utils import comment
+	return quiet(lambda: comment('benchmark comment with a stage position of [12345 67890]'))
+
+def setup_stage_response(frames):
+	from stage_controller import stage_controller
+	stage = SimpleNamespace(ser = fake_serial(b'123456,-78901,0\r'))
+	return quiet(lambda: stage_controller.get_response(stage))
+
+def setup_laser_response(frames):
+	from laser_controller import laser_controller
+	laser = SimpleNamespace(ser = fake_serial(b'OK\r\n'))
+	return quiet(lambda: laser_controller.get_response(laser))
+
+def setup_hough_detector(frames):
+	from hough_detector import hough_detector
+	detector = hough_detector()
+	frame_cycle = itertools.cycle(frames)
+	return lambda: detector.detect(next(frame_cycle),'red')
+
+def setup_cnn_detector(frames):
+	# the whole network path for one frame, to compare with the hough detector
+	from sklearn.preprocessing import StandardScaler
+	from localizer_pipeline import preprocess_for_network,postprocess_network_output,threshold_based_on_type
+	from target_extraction import extract_targets,get_probability_image
+	from model_cache import load_cached_model
+	model,_ = load_cached_model(os.path.join(models_folder_location,'model2018-10-18_08_47'),compile = False)
+	norm = StandardScaler()
+	frame_cycle = itertools.cycle(frames)
+	def detect():
+		segmented_image = postprocess_network_output(model.predict(
+			preprocess_for_network(next(frame_cycle),norm),batch_size = 1),'multi')
+		return extract_targets(threshold_based_on_type(segmented_image,'red'),
+			get_probability_image(segmented_image,'red'),'red')
+	return quiet(detect)
+
+def setup_mean_iou(metric_name):
+	def setup(frames):
+		import tensorflow as tf
+		from iou_metrics import MeanIoU
+		metric = MeanIoU(3)
+		# a training batch of 8 network outputs against their one-hot masks
+		y_pred = np.concatenate([fake_network_output(frame) for frame in frames*8][:8])
+		y_true = np.eye(3)[np.argmax(y_pred[:,::-1],axis = -1)]
+		y_true_input = tf.placeholder(tf.float32,y_true.shape)
+		y_pred_input = tf.placeholder(tf.float32,y_pred.shape)
+		output = getattr(metric,metric_name)(y_true_input,y_pred_input)
+		session = tf.Session()
+		feed_dict = {y_true_input:y_true,y_pred_input:y_pred}
+		return lambda: session.run(output,feed_dict)
+	return setup
+
+benchmarks = [
+	('localizer network preprocessing',setup_network_preprocessing),
+	('localizer network postprocessing',setup_network_postprocessing),
+	('threshold_based_on_type',setup_threshold_based_on_type),
+	('extract_targets',setup_extract_targets),
+	('hough detector',setup_hough_detector),
+	('cnn detector',setup_cnn_detector),
+	('wellStitcher.stitch_img',setup_stitch_img),
+	('ShowVideo CLAHE',setup_clahe),
+	('ShowVideo temporal average',setup_temporal_filter('average')),
+	('ShowVideo temporal median',setup_temporal_filter('median')),
+	('utils.comment',setup_comment),
+	('stage serial response parsing',setup_stage_response),
+	('laser serial response parsing',setup_laser_response),
+	('MeanIoU py_func',setup_mean_iou('py_func_mean_iou')),
+	('MeanIoU graph',setup_mean_iou('mean_iou')),
+	]
+
+def run_benchmarks(repeats,selected = None):
+	frames = load_frames()
+	if len(frames) == 0: sys.exit('no frames found in {}'.format(models_folder_location))
+	results = {}
+	for name,setup in benchmarks:
+		if selected is not None and not any(s in name for s in selected): continue
+		try:
+			function = setup(frames)
+			# the pipeline imports some packages on first use, so a missing one can show up here too
+			function()
+		except (ImportError,OSError) as e:
+			# missing packages, or a model file that isn't on this machine
+			results[name] = {'skipped':str(e)}
+			print('{:<40} skipped ({})'.format(name,e))
+			continue
+		results[name] = time_function(function,repeats)
+		print('{:<40} median {:9.3f} ms  p90 {:9.3f} ms'.format(name,
+			results[name]['median ms'],results[name]['p90 ms']))
+	return results
+
+def compare(results,previous):
+	print('\n{:<40} {:>12} {:>12} {:>8}'.format('benchmark','before ms','after ms','ratio'))
+	for name,result in results.items():
+		old = previous.get(name,{})
+		if 'median ms' not in result or 'median ms' not in old: continue
+		print('{:<40} {:12.3f} {:12.3f} {:8.2f}'.format(name,old['median ms'],
+			result['median ms'],result['median ms']/old['median ms']))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'micro-benchmarks for the LCL hot paths')
+	parser.add_argument('--output',default = 'benchmark_results.json',help = 'json file to write results to')
+	parser.add_argument('--repeats',type = int,default = 50)
+	parser.add_argument('--only',nargs = '*',help = 'run only benchmarks whose names contain these strings')
+	parser.add_argument('--compare',help = 'earlier results file to compare against')
+	args = parser.parse_args()
+	results = {'commit':get_commit(),
+		'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+		'python':platform.python_version(),
+		'opencv':cv2.__version__,
+		'benchmarks':run_benchmarks(args.repeats,args.only)}
+	with open(args.output,'w') as f:
+		json.dump(results,f,indent = 2)
+	print('results written to {}'.format(args.output))
+	if args.compare:
+		with open(args.compare,'r') as f:
+			compare(results['benchmarks'],json.load(f)['benchmarks'])
@@ -0,0 +1,86 @@
+import time,threading
+import cv2
+
+class camera_capture():
+	'''
+	grabs frames on its own thread as fast as the camera delivers them, so
+	the driver never builds up a queue of old frames, and only decodes a
+	frame when somebody is waiting for it. frames are stamped with the time
+	they were grabbed so callers can ask for the newest frame captured after
+	a given time. frames are shared between callers, copy before drawing
+	'''
+	def __init__(self,camera_port,width = 1024,height = 822):
+		self.camera = cv2.VideoCapture(camera_port)
+		self.camera.set(cv2.CAP_PROP_FRAME_WIDTH,width)
+		self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT,height)
+		# not every backend honours this, grabbing continuously keeps the buffer empty anyway
+		self.camera.set(cv2.CAP_PROP_BUFFERSIZE,1)
+		self.condition = threading.Condition()
+		self.frame = None
+		self.frame_time = 0.
+		self.grab_time = 0.
+		self.grab_count = 0
+		self.decode_count = 0
+		self.failed_grabs = 0
+		# the after times of everyone waiting for a frame
+		self.requests = []
+		self.running = False
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target = self.grab_loop,daemon = True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		self.thread.join(1)
+		self.camera.release()
+
+	def grab_loop(self):
+		while self.running:
+			if not self.camera.grab():
+				self.failed_grabs += 1
+				time.sleep(.01)
+				continue
+			grab_time = time.time()
+			with self.condition:
+				self.grab_time = grab_time
+				self.grab_count += 1
+				decode = any(after_time < grab_time for after_time in self.requests)
+			if not decode: continue
+			ret,frame = self.camera.retrieve()
+			with self.condition:
+				if ret:
+					self.frame = frame
+					self.frame_time = grab_time
+					self.decode_count += 1
+				self.condition.notify_all()
+
+	def get_frame_after(self,after_time,timeout = 1.):
+		'''
+		returns the newest frame grabbed after after_time and its grab time,
+		waiting for one if need be. returns None,None on timeout
+		'''
+		deadline = time.time() + timeout
+		with self.condition:
+			if self.frame is not None and self.frame_time > after_time and self.frame_time >= self.grab_time:
+				return self.frame,self.frame_time
+			# the last decoded frame is older than the last grab, wait for the next one
+			after_time = max(after_time,self.grab_time)
+			self.requests.append(after_time)
+			try:
+				while self.frame is None or self.frame_time <= after_time:
+					remaining = deadline - time.time()
+					if remaining <= 0: return None,None
+					self.condition.wait(remaining)
+				return self.frame,self.frame_time
+			finally:
+				self.requests.remove(after_time)
+
+	def get_latest_frame(self,timeout = 1.):
+		# a frame grabbed from now on, rather than whatever was decoded last
+		return self.get_frame_after(time.time(),timeout)
+
+	def summary(self):
+		return 'camera capture: grabbed {} frames, decoded {}, {} failed grabs'.format(
+			self.grab_count,self.decode_count,self.failed_grabs)
@@ -0,0 +1,128 @@
+'''
+image/mask training pairs stored as numbered .npy chunks plus a json index.
+chunks are memory mapped, so samples are read from disk as they are needed
+and the dataset can be bigger than memory. convert an old pickled dataset
+with:
+
+	python chunked_dataset.py training_data_normalized.p training_data
+'''
+import os,sys,json,pickle
+import numpy as np
+
+def write_json(file_location,data):
+	with open(file_location + '.tmp','w') as f:
+		json.dump(data,f,indent = 2)
+	os.replace(file_location + '.tmp',file_location)
+
+class chunked_dataset():
+	def __init__(self,folder_location):
+		self.folder_location = folder_location
+		with open(os.path.join(folder_location,'index.json'),'r') as f:
+			self.index = json.load(f)
+		self.chunk_lengths = np.array([chunk['length'] for chunk in self.index['chunks']],dtype = np.int64)
+		self.chunk_starts = np.concatenate([[0],np.cumsum(self.chunk_lengths)[:-1]]).astype(np.int64)
+		self.arrays = {}
+
+	def __len__(self):
+		return int(self.chunk_lengths.sum())
+
+	def __getstate__(self):
+		# memory maps are reopened in each worker process rather than pickled
+		state = self.__dict__.copy()
+		state['arrays'] = {}
+		return state
+
+	def get_chunk(self,chunk_number):
+		if chunk_number not in self.arrays:
+			chunk = self.index['chunks'][chunk_number]
+			self.arrays[chunk_number] = tuple(np.load(os.path.join(self.folder_location,chunk[key]),mmap_mode = 'r')
+				for key in ('x','y'))
+		return self.arrays[chunk_number]
+
+	def get_samples(self,indices):
+		'''
+		returns the images and masks at the given dataset indices as arrays
+		'''
+		indices = np.asarray(indices,dtype = np.int64)
+		chunk_numbers = np.searchsorted(self.chunk_starts,indices,side = 'right') - 1
+		offsets = indices - self.chunk_starts[chunk_numbers]
+		xs,ys = [],[]
+		for chunk_number,offset in zip(chunk_numbers,offsets):
+			x,y = self.get_chunk(chunk_number)
+			xs.append(x[offset])
+			ys.append(y[offset])
+		return np.stack(xs),np.stack(ys)
+
+class chunked_dataset_writer():
+	'''
+	writes samples into a chunked_dataset, appending to it if it already
+	exists. the index is rewritten after each chunk, so the chunks written
+	so far are always a readable dataset. each sample can record where it
+	came from, so an interrupted writer can tell what is already saved
+	'''
+	def __init__(self,folder_location,chunk_size = 256):
+		self.folder_location = folder_location
+		self.chunk_size = chunk_size
+		os.makedirs(folder_location,exist_ok = True)
+		index_location = os.path.join(folder_location,'index.json')
+		if os.path.exists(index_location):
+			with open(index_location,'r') as f:
+				self.index = json.load(f)
+		else:
+			self.index = {'chunks':[]}
+		self.x_buffer,self.y_buffer,self.source_buffer = [],[],[]
+
+	def __len__(self):
+		return sum(chunk['length'] for chunk in self.index['chunks']) + len(self.x_buffer)
+
+	def get_saved_sources(self):
+		return set(source for chunk in self.index['chunks'] for source in chunk.get('sources',[]))
+
+	def add(self,x,y,source = None):
+		self.x_buffer.append(x)
+		self.y_buffer.append(y)
+		self.source_buffer.append(source)
+		if len(self.x_buffer) >= self.chunk_size: self.flush()
+
+	def add_many(self,xs,ys):
+		for x,y in zip(xs,ys):
+			self.add(x,y)
+
+	def flush(self):
+		if len(self.x_buffer) == 0: return
+		chunk_number = len(self.index['chunks'])
+		chunk = {'length':len(self.x_buffer)}
+		for key,buffer in (('x',self.x_buffer),('y',self.y_buffer)):
+			file_name = '{}_{:05d}.npy'.format(key,chunk_number)
+			with open(os.path.join(self.folder_location,file_name + '.tmp'),'wb') as f:
+				np.save(f,np.stack(buffer))
+			os.replace(os.path.join(self.folder_location,file_name + '.tmp'),os.path.join(self.folder_location,file_name))
+			chunk[key] = file_name
+		if any(source is not None for source in self.source_buffer): chunk['sources'] = self.source_buffer
+		self.index['chunks'].append(chunk)
+		write_json(os.path.join(self.folder_location,'index.json'),self.index)
+		self.x_buffer,self.y_buffer,self.source_buffer = [],[],[]
+
+	def close(self):
+		self.flush()
+
+def convert_pickle(pickle_location,output_location,chunk_size = 256):
+	'''
+	splits a pickled (x_train,x_val,y_train,y_val) or (x_train,y_train)
+	dataset into train and val chunked datasets
+	'''
+	with open(pickle_location,'rb') as f:
+		data = pickle.load(f)
+	if len(data) == 4:
+		x_train,x_val,y_train,y_val = data
+		splits = {'train':(x_train,y_train),'val':(x_val,y_val)}
+	else:
+		splits = {'train':data}
+	for split,(xs,ys) in splits.items():
+		writer = chunked_dataset_writer(os.path.join(output_location,split),chunk_size)
+		writer.add_many(xs,ys)
+		writer.close()
+		print('wrote {} {} samples to {}'.format(len(xs),split,writer.folder_location))
+
+if __name__ == '__main__':
+	convert_pickle(sys.argv[1],sys.argv[2])
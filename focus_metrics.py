@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+
+def get_roi(img,roi_fraction = .5,downsample = 2):
+	'''
+	returns a grayscale float32 crop from the centre of the frame,
+	downsampled so that scoring can keep up with the camera
+	'''
+	if img.ndim == 3:
+		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+	h,w = img.shape
+	roi_h,roi_w = int(h*roi_fraction),int(w*roi_fraction)
+	y0,x0 = (h - roi_h)//2,(w - roi_w)//2
+	roi = img[y0:y0+roi_h,x0:x0+roi_w]
+	if downsample > 1:
+		roi = cv2.resize(roi,(roi_w//downsample,roi_h//downsample),interpolation = cv2.INTER_AREA)
+	return roi.astype(np.float32)
+
+def variance_of_laplacian(roi):
+	return float(cv2.Laplacian(roi, cv2.CV_32F).var())
+
+def tenengrad(roi):
+	gx = cv2.Sobel(roi, cv2.CV_32F, 1, 0)
+	gy = cv2.Sobel(roi, cv2.CV_32F, 0, 1)
+	return float(np.mean(gx*gx + gy*gy))
+
+def brenner(roi):
+	diff = roi[:,2:] - roi[:,:-2]
+	return float(np.mean(diff*diff))
+
+focus_metric_dict = {
+	'variance of laplacian':variance_of_laplacian,
+	'tenengrad':tenengrad,
+	'brenner':brenner
+	}
+
+def get_focus_scores(img,roi_fraction = .5,downsample = 2):
+	'''
+	computes every metric in focus_metric_dict on a single shared roi
+	'''
+	roi = get_roi(img,roi_fraction,downsample)
+	return {name:metric(roi) for name,metric in focus_metric_dict.items()}
+
+def match_scores_to_positions(score_times,position_times,positions):
+	'''
+	interpolates the stepper position at the time each score was taken,
+	using the timestamped position change events from the stepper
+	'''
+	return np.interp(score_times,position_times,positions)
+
+class focus_map():
+	'''
+	least squares fit of objective focus position over stage xy. uses a
+	quadratic surface when there are enough points, otherwise a plane or
+	a constant
+	'''
+	def __init__(self):
+		self.points = []
+		self.coefficients = None
+		self.origin = np.zeros(2)
+
+	def add_point(self,x,y,focus_position):
+		self.points.append((x,y,focus_position))
+
+	def get_terms(self,x,y):
+		# stage coordinates are large, so fit about the centre of the points
+		x = np.asarray(x,dtype = np.float64) - self.origin[0]
+		y = np.asarray(y,dtype = np.float64) - self.origin[1]
+		terms = [np.ones_like(x),x,y,x*x,x*y,y*y]
+		if len(self.points) >= 6: return np.stack(terms,axis = -1)
+		if len(self.points) >= 3: return np.stack(terms[:3],axis = -1)
+		return np.stack(terms[:1],axis = -1)
+
+	def fit(self):
+		points = np.array(self.points,dtype = np.float64)
+		self.origin = points[:,:2].mean(axis = 0)
+		terms = self.get_terms(points[:,0],points[:,1])
+		self.coefficients,_,_,_ = np.linalg.lstsq(terms,points[:,2],rcond = None)
+		residuals = points[:,2] - terms.dot(self.coefficients)
+		return float(np.sqrt(np.mean(residuals**2)))
+
+	def predict(self,x,y):
+		return int(np.rint(self.get_terms(x,y).dot(self.coefficients)))
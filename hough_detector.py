@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+from target_extraction import target_dtype,class_dict
+
+class hough_detector():
+	'''
+	classical cell detector, finding round cells with a hough circle
+	transform. it needs no tensorflow and takes a few milliseconds, so it
+	can stand in for the localizer network. sizes are given in full camera
+	pixels and scaled to the downsampled frame it works on. targets come
+	back in the same format and output frame as the network path
+	'''
+	def __init__(self,downsample = 4,blur_size = 5,erode_size = 5,dp = 3,min_distance = 200,
+		min_radius = 50,max_radius = 100,output_size = (125,125)):
+		self.downsample = downsample
+		# blur kernel size should relate to cell wall thickness, median blurs need an odd size
+		self.blur_size = max(int(blur_size/downsample)//2*2 + 1,3)
+		# probably want to erode about half of the cell wall thickness
+		erode_size = int(round(erode_size/downsample))
+		self.erode_kernel = np.ones((erode_size,erode_size),np.uint8) if erode_size > 1 else None
+		# dp is relative to the image we search, the full resolution value finds
+		# the same circles at a quarter resolution on our frames
+		self.dp = dp
+		self.min_distance = min_distance/downsample
+		self.min_radius = int(round(min_radius/downsample))
+		self.max_radius = int(round(max_radius/downsample))
+		self.output_size = output_size
+
+	def preprocess(self,img):
+		if img.ndim == 3: img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+		img = cv2.resize(img,(img.shape[1]//self.downsample,img.shape[0]//self.downsample),
+			interpolation = cv2.INTER_AREA)
+		img = cv2.medianBlur(img,self.blur_size)
+		img = cv2.normalize(img,None,0,255,cv2.NORM_MINMAX)
+		if self.erode_kernel is not None: img = cv2.erode(img,self.erode_kernel)
+		return img
+
+	def detect(self,img,cell_type = 'red'):
+		'''
+		returns the targets and a label image in the output frame, like
+		target_extraction.extract_targets
+		'''
+		small = self.preprocess(img)
+		circles = cv2.HoughCircles(small,cv2.HOUGH_GRADIENT,self.dp,self.min_distance,
+			minRadius = self.min_radius,maxRadius = self.max_radius)
+		circles = np.zeros((0,3),np.float32) if circles is None else circles[0,:,:3]
+		scale = np.array(self.output_size,dtype = np.float32)/[small.shape[1],small.shape[0]]
+		x,y = circles[:,0]*scale[0],circles[:,1]*scale[1]
+		radius = circles[:,2]*scale.mean()
+		labels = np.zeros((self.output_size[1],self.output_size[0]),np.int32)
+		for i in range(len(circles)):
+			cv2.circle(labels,(int(round(x[i])),int(round(y[i]))),int(round(radius[i])),i + 1,-1)
+		targets = np.zeros(len(circles),dtype = target_dtype)
+		targets['label'] = np.arange(1,len(circles) + 1)
+		targets['x'],targets['y'] = x,y
+		targets['area'] = np.bincount(labels.ravel(),minlength = len(circles) + 1)[1:]
+		x0,y0 = np.clip(np.floor(x - radius),0,None),np.clip(np.floor(y - radius),0,None)
+		x1 = np.clip(np.ceil(x + radius) + 1,None,self.output_size[0])
+		y1 = np.clip(np.ceil(y + radius) + 1,None,self.output_size[1])
+		targets['bbox'] = np.stack([x0,y0,x1 - x0,y1 - y0],axis = -1)
+		# the hough transform doesn't give a usable score, every circle it finds counts
+		targets['confidence'] = 1
+		targets['class'] = class_dict.get(cell_type,-1)
+		return targets,labels
@@ -2,8 +2,8 @@ import cv2,os
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
-import pickle
 import sys
+from chunked_dataset import chunked_dataset_writer
 
 global fill_val, last_x, last_y
 last_x = -1
@@ -15,7 +15,7 @@ last_y = -1
 test_file_path = r'C:\Users\Harrison\ownCloud\sd_experiment_26_02_2018___11.47.48.277723\2\before_qswitch___26_02_2018___13.59.55.413329.tif'
 
 
-# python image_annotator_backup.py "Multiplicity Test Small" out.p 14
+# python image_annotator_backup.py "Multiplicity Test Small" training_data/train 14
 
 def fill_contour(mask):
 	im2, contours, hierarchy = cv2.findContours(mask,cv2.RETR_CCOMP,cv2.CHAIN_APPROX_SIMPLE)
@@ -60,6 +60,9 @@ def mouse_event(event, x, y, flags, param):
 		cv2.imshow('ground_truth', mask_final)
 	#cv2.imshow('ground_truth',mask_final)		
 
+def load_image(im_path):
+	img = cv2.imread(im_path,0)
+	return cv2.resize(img,(500,500))
  
 
 
@@ -68,95 +71,82 @@ if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(description='Input file path to create ground truth from.')
 	parser.add_argument('data_path', help='path for image files')
-	parser.add_argument('output_path', help='path for output GT files')
+	parser.add_argument('output_path', help='chunked dataset folder to add the GT to, created if needed')
 	parser.add_argument('multiplicity', help='number of repeated images')
 	args = parser.parse_args()
-	x_train = np.zeros((1,500,500))
-	y_train = np.zeros((1,500,500))
+	# each annotated set is saved as soon as it is done, so we can pick up where we left off
+	writer = chunked_dataset_writer(args.output_path,chunk_size = 64)
+	saved = writer.get_saved_sources()
 	mult = int(args.multiplicity)+1
-	count = mult
 	fill_val = 255
-	for f in os.listdir(args.data_path):
+	file_names = sorted(f for f in os.listdir(args.data_path) if '.tif' in f)
+	image_sets = [file_names[i:i+mult] for i in range(0,len(file_names),mult)]
+	print('{} samples already saved in {}'.format(len(writer),args.output_path))
+	for image_set in image_sets:
+		f = image_set[0]
+		if f in saved:
+			continue
 		annotating = True		
-		if (('.tif' in f)&(count%mult==0)):		# Branch for first image in set
-			im_path = os.path.join(args.data_path,f)
-			print('\nTrace the cell outline for:', f)
-			img = cv2.imread(im_path,0)
-			img = cv2.resize(img,(500,500))
-			y = np.copy(img)
-			mask = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-			mask_final = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-			mask_display = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-			cv2.namedWindow('image')
-			cv2.setMouseCallback('image', mouse_event)		#MOUSE EVENT
-			cv2.imshow('image',img)
-			cv2.namedWindow('ground_truth')
-			cv2.imshow('ground_truth',mask_display)
-			while (annotating == True):
-				res = cv2.waitKey(0)
-				#print('Waitkey pressed = ',res)
-				#print(x_train.shape,y_train.shape)
-				if res == 32: 				# 'Spacebar'
-					x = np.copy(mask_final)
-					mask_to_store = np.copy(mask_final)
-					cv2.destroyAllWindows()
-					# f = f.split('.tif')[0] + '_ANNOTATED.tif'
-					# out_path = os.path.join(args.output_path,f)
-					# cv2.imwrite(out_path,mask)
-					x = np.expand_dims(x,axis = 0)			
-					y = np.expand_dims(y,axis = 0)			
-					x_train = np.concatenate((x_train,x),axis=0)
-					y_train = np.concatenate((y_train,y),axis=0)
-					print('     ', x_train.shape,y_train.shape)
-					annotating = False
-					count = count+1
-				elif res == 101:				# 'E' key
-					mask = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-					mask_final = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-					mask_display = np.uint8(np.zeros((img.shape[0],img.shape[1])))
-					cv2.imshow('ground_truth',mask)
-					cv2.imshow('image',img)
-					#cv2.setMouseCallback('image', mouse_event)		#MOUSE EVENT
-					print('\n     Erased.\n')
-					mask_to_store = np.copy(mask)
-				elif res ==27:				# 'ESC' key
-					print('\n     ESC key pressed. Program terminated.')
-					sys.exit()
-					cv2.destroyAllWindows()
-					break
-				elif res ==49:     			# '1' key
-					fill_val = 255
-					print('\n     Cell type 1.\n')
-				elif res ==50:				# '2' key
-					fill_val = 85
-					print('\n     Cell type 2.\n')
-				elif res ==51:				# '3' key
-					fill_val = 170
-					print('\n     Cell type 3.\n')
-				else:
-					print('\n     You pressed Waitkey',res)
-					print('     That key does nothing.')
-				
-		elif (('.tif' in f)&(count%mult!=0)):				# Branch for remaining images in set
-			x = mask_to_store				# Copy in the stored mask
+		# Branch for first image in set
+		im_path = os.path.join(args.data_path,f)
+		print('\nTrace the cell outline for:', f)
+		img = load_image(im_path)
+		y = np.copy(img)
+		mask = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+		mask_final = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+		mask_display = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+		cv2.namedWindow('image')
+		cv2.setMouseCallback('image', mouse_event)		#MOUSE EVENT
+		cv2.imshow('image',img)
+		cv2.namedWindow('ground_truth')
+		cv2.imshow('ground_truth',mask_display)
+		while (annotating == True):
+			res = cv2.waitKey(0)
+			#print('Waitkey pressed = ',res)
+			if res == 32: 				# 'Spacebar'
+				mask_to_store = np.copy(mask_final)
+				cv2.destroyAllWindows()
+				# f = f.split('.tif')[0] + '_ANNOTATED.tif'
+				# out_path = os.path.join(args.output_path,f)
+				# cv2.imwrite(out_path,mask)
+				# x is the image and y its mask, as the training script expects
+				writer.add(y,mask_to_store,f)
+				annotating = False
+			elif res == 101:				# 'E' key
+				mask = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+				mask_final = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+				mask_display = np.uint8(np.zeros((img.shape[0],img.shape[1])))
+				cv2.imshow('ground_truth',mask)
+				cv2.imshow('image',img)
+				#cv2.setMouseCallback('image', mouse_event)		#MOUSE EVENT
+				print('\n     Erased.\n')
+				mask_to_store = np.copy(mask)
+			elif res ==27:				# 'ESC' key
+				print('\n     ESC key pressed. Program terminated.')
+				print('     {} samples saved in {}'.format(len(writer),args.output_path))
+				cv2.destroyAllWindows()
+				sys.exit()
+			elif res ==49:     			# '1' key
+				fill_val = 255
+				print('\n     Cell type 1.\n')
+			elif res ==50:				# '2' key
+				fill_val = 85
+				print('\n     Cell type 2.\n')
+			elif res ==51:				# '3' key
+				fill_val = 170
+				print('\n     Cell type 3.\n')
+			else:
+				print('\n     You pressed Waitkey',res)
+				print('     That key does nothing.')
+
+		# Branch for remaining images in set, they share the stored mask
+		for f in image_set[1:]:
 			im_path = os.path.join(args.data_path,f)
 			print('     copying GT for:', f)
-			img = cv2.imread(im_path,0)
-			img = cv2.resize(img,(500,500))
-			y = np.copy(img)
-			x = np.expand_dims(x,axis = 0)			
-			y = np.expand_dims(y,axis = 0)			
-			x_train = np.concatenate((x_train,x),axis=0)
-			y_train = np.concatenate((y_train,y),axis=0)
-			print(x_train.shape,y_train.shape)
-			count = count+1
-			annotating = False
-			
-			
-		pass
-		#print('Moving to next file.')
-		
-	x_train = y_train[1:,:,:]			
-	y_train = x_train[1:,:,:]			
-	pickle.dump((x_train,y_train),open(args.output_path,'wb'))
-	print('\n     Done.')
\ No newline at end of file
+			writer.add(load_image(im_path),mask_to_store,f)
+		# end the chunk with the set so a crash can only lose the set in progress
+		writer.flush()
+		print('     ', len(writer), 'samples saved')
+
+	writer.close()
+	print('\n     Done.')
@@ -0,0 +1,134 @@
+'''
+mean intersection over union for the localizer models, as tensorflow ops
+so the metric stays in the graph. the numpy version it replaced is kept to
+check against:
+
+	python iou_metrics.py
+
+tensorflow and keras are imported inside the functions so the GUI can
+import this module without loading them
+'''
+import time
+import numpy as np
+
+def np_confusion_matrix(y_true,y_pred,num_classes):
+	# Convert predictions and target from categorical to integer format
+	target = np.argmax(y_true, axis=-1).ravel()
+	predicted = np.argmax(y_pred, axis=-1).ravel()
+	# Trick from torchnet for bincounting 2 arrays together
+	# https://github.com/pytorch/tnt/blob/master/torchnet/meter/confusionmeter.py
+	x = predicted + num_classes * target
+	bincount_2d = np.bincount(x.astype(np.int32), minlength=num_classes**2)
+	assert bincount_2d.size == num_classes**2
+	return bincount_2d.reshape((num_classes, num_classes))
+
+def confusion_matrix(y_true,y_pred,num_classes):
+	'''
+	rows are the true class and columns the predicted class, like
+	np_confusion_matrix
+	'''
+	import tensorflow as tf
+	target = tf.reshape(tf.argmax(y_true,axis = -1),[-1])
+	predicted = tf.reshape(tf.argmax(y_pred,axis = -1),[-1])
+	return tf.confusion_matrix(target,predicted,num_classes = num_classes,dtype = tf.float32)
+
+def mean_iou_from_confusion(conf):
+	import tensorflow as tf
+	true_positive = tf.diag_part(conf)
+	false_positive = tf.reduce_sum(conf,0) - true_positive
+	false_negative = tf.reduce_sum(conf,1) - true_positive
+	# classes that never appear have no true positives either, so they count as 0
+	iou = true_positive/tf.maximum(true_positive + false_positive + false_negative,1)
+	return tf.reduce_mean(iou)
+
+class MeanIoU(object):
+	# taken from http://www.davidtvs.com/keras-custom-metrics/
+	def __init__(self, num_classes):
+		super().__init__()
+		self.num_classes = num_classes
+
+	def mean_iou(self, y_true, y_pred):
+		# mean IoU of the batch, computed in the graph
+		return mean_iou_from_confusion(confusion_matrix(y_true, y_pred, self.num_classes))
+
+	def py_func_mean_iou(self, y_true, y_pred):
+		# the old metric, np_mean_iou wrapped as a TensorFlow op
+		import tensorflow as tf
+		return tf.py_func(self.np_mean_iou, [y_true, y_pred], tf.float32)
+
+	def np_mean_iou(self, y_true, y_pred):
+		conf = np_confusion_matrix(y_true, y_pred, self.num_classes)
+
+		# Compute the IoU and mean IoU from the confusion matrix
+		true_positive = np.diag(conf)
+		false_positive = np.sum(conf, 0) - true_positive
+		false_negative = np.sum(conf, 1) - true_positive
+
+		# Just in case we get a division by 0, ignore/hide the error and set the value to 0
+		with np.errstate(divide='ignore', invalid='ignore'):
+			iou = true_positive / (true_positive + false_positive + false_negative)
+		iou[np.isnan(iou)] = 0
+
+		return np.mean(iou).astype(np.float32)
+
+	def streaming_mean_iou(self):
+		# the stateful metric layer needs keras, so it is only defined when asked for
+		from keras import backend as K
+		from keras.layers import Layer
+		num_classes = self.num_classes
+
+		class streaming_mean_iou(Layer):
+			'''
+			mean IoU of everything seen since the last reset, keras resets
+			it at the start of each epoch and before validation
+			'''
+			def __init__(self, name='streaming_mean_iou', **kwargs):
+				super().__init__(name=name, **kwargs)
+				self.stateful = True
+				self.confusion = K.zeros((num_classes, num_classes), name='confusion')
+
+			def reset_states(self):
+				K.set_value(self.confusion, np.zeros((num_classes, num_classes)))
+
+			def __call__(self, y_true, y_pred):
+				conf = confusion_matrix(y_true, y_pred, num_classes)
+				self.add_update(K.update_add(self.confusion, conf), inputs=[y_true, y_pred])
+				return mean_iou_from_confusion(self.confusion + conf)
+
+		return streaming_mean_iou()
+
+if __name__ == '__main__':
+	import tensorflow as tf
+	from keras import backend as K
+	num_classes,repeats = 3,50
+	metric = MeanIoU(num_classes)
+	y_true_input = tf.placeholder(tf.float32,(None,128,128,num_classes))
+	y_pred_input = tf.placeholder(tf.float32,(None,128,128,num_classes))
+	outputs = {'py_func':metric.py_func_mean_iou(y_true_input,y_pred_input),
+		'graph':metric.mean_iou(y_true_input,y_pred_input)}
+	streaming = metric.streaming_mean_iou()
+	streaming_output = streaming(y_true_input,y_pred_input)
+	session = K.get_session()
+	random_state = np.random.RandomState(0)
+	y_trues,y_preds = [],[]
+	for batch_size in [1,8,100]:
+		# leave class 0 out of the first batch so the divide by zero case is covered
+		y_true = np.eye(num_classes)[random_state.randint(0 if batch_size > 1 else 1,num_classes,size = (batch_size,128,128))]
+		y_pred = random_state.rand(batch_size,128,128,num_classes)
+		if batch_size == 1: y_pred[...,0] = -1
+		y_trues.append(y_true)
+		y_preds.append(y_pred)
+		feed_dict = {y_true_input:y_true,y_pred_input:y_pred}
+		expected = metric.np_mean_iou(y_true,y_pred)
+		for name,output in outputs.items():
+			value = session.run(output,feed_dict)
+			start_time = time.perf_counter()
+			for i in range(repeats): session.run(output,feed_dict)
+			print('batch {:>3} {:<8} mean IoU {:.6f} (numpy {:.6f}) {:8.3f} ms'.format(batch_size,name,value,expected,
+				1000*(time.perf_counter() - start_time)/repeats))
+			assert abs(value - expected) < 1e-5
+		value,_ = session.run([streaming_output,streaming.updates],feed_dict)
+	expected = metric.np_mean_iou(np.concatenate([y.reshape(-1,num_classes) for y in y_trues]),
+		np.concatenate([y.reshape(-1,num_classes) for y in y_preds]))
+	print('streaming mean IoU over all batches {:.6f} (numpy {:.6f})'.format(value,expected))
+	assert abs(value - expected) < 1e-5
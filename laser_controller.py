@@ -1,11 +1,17 @@
 import serial
+import time,threading
 import numpy as np
 from utils import comment
+from session_recorder import record_event
 from PyQt5 import QtCore
 
-class laser_controller():
+class laser_controller(QtCore.QObject):
+	burst_complete_signal = QtCore.pyqtSignal('PyQt_PyObject')
 
-	def __init__(self):
+	def __init__(self,parent = None):
+		super(laser_controller, self).__init__(parent)
+		# bursts run on the laser thread while the GUI can still send single commands
+		self.serial_lock = threading.Lock()
 		com = 'COM10'
 		baud = 9600
 		parity = serial.PARITY_NONE
@@ -19,10 +25,12 @@ class laser_controller():
 		self.set_delay(200)
 		self.ready_to_fire = False
 
-	def issue_command(self,command):
+	def issue_command(self,command,suppress_msg = False):
 		command_string = '{}\r\n'.format(command)
-		comment('sending command to laser:{}'.format(command_string.split('\r')[0]))
-		self.ser.write(command_string.encode('utf-8'))
+		if(not suppress_msg):
+			comment('sending command to laser:{}'.format(command_string.split('\r')[0]))
+		with self.serial_lock:
+			self.ser.write(command_string.encode('utf-8'))
 	
 	def get_response(self):
 		response = ''
@@ -49,16 +57,65 @@ class laser_controller():
 		self.ready_to_fire = True
 		return self.send_receive('A')
 
+	def send_qswitch(self,command,suppress_msg = False):
+		'''
+		sends a qswitch command if the flash lamp is running, returns the
+		time it was sent or None if the laser isn't ready to fire
+		'''
+		if not self.ready_to_fire: return None
+		self.issue_command(command,suppress_msg)
+		return time.time()
+
 	def fire_qswitch(self):
-		if self.ready_to_fire: 
-			return self.send_receive('OP')
+		fire_time = self.send_qswitch('OP')
+		if fire_time is not None: record_event('qswitch','single',fire_time)
 
 	def set_delay(self,delay):
 		if str(delay) != '':
 			self.send_receive('W {}'.format(delay))
 
 	def qswitch_auto(self):
-		if self.ready_to_fire: return self.send_receive('CC')
+		fire_time = self.send_qswitch('CC')
+		if fire_time is not None: record_event('qswitch','auto',fire_time)
+
+	def fire_burst(self,num_pulses,rate,delay = None,arm = True):
+		'''
+		fires num_pulses qswitch shots at rate (Hz) as a single operation,
+		optionally setting the qswitch delay first. returns the time each
+		shot was written to the laser, empty if none were fired. with arm the
+		flash lamp is started first if it isn't running yet
+		'''
+		if arm and not self.ready_to_fire:
+			# the flash start from the GUI thread may not have arrived yet
+			comment('flash lamp not running, starting it before the burst')
+			self.fire_auto()
+		if not self.ready_to_fire:
+			comment('laser not ready to fire, burst of {} pulses not fired'.format(num_pulses))
+			return []
+		if delay is not None: self.set_delay(delay)
+		period = 1./rate
+		pulse_times = []
+		start_time = time.perf_counter()
+		for i in range(num_pulses):
+			# sleep most of the way then spin so the pulses stay evenly spaced
+			fire_time = start_time + i*period
+			while fire_time - time.perf_counter() > .002: time.sleep(.001)
+			while time.perf_counter() < fire_time: pass
+			pulse_time = self.send_qswitch('OP',suppress_msg = True)
+			if pulse_time is None:
+				comment('flash lamp stopped after {} of {} pulses'.format(len(pulse_times),num_pulses))
+				break
+			pulse_times.append(pulse_time)
+		for i,pulse_time in enumerate(pulse_times):
+			record_event('qswitch','burst pulse {} of {}'.format(i + 1,num_pulses),pulse_time)
+		comment('fired burst of {} pulses at {} Hz, pulse times: {}'.format(
+			len(pulse_times),rate,pulse_times))
+		return pulse_times
+
+	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject')
+	def fire_burst_slot(self,num_pulses,rate):
+		# the pulse timing loop holds this thread for the whole burst, so it runs on the laser thread
+		self.burst_complete_signal.emit(self.fire_burst(num_pulses,rate))
 
 
 class attenuator_controller():
@@ -1,19 +1,21 @@
-import time
+import time,threading,queue,json
 from utils import comment,now
-from keras.models import load_model
 import os
 from PyQt5 import QtCore 
 import cv2
 import numpy as np
-import tensorflow as tf
-global graph
 from PyQt5.QtWidgets import QApplication
 import pickle
-from sklearn.preprocessing import StandardScaler
 from utils import MeanIoU
-from keras import backend as K
-graph = tf.get_default_graph()
-import skimage.transform as transform
+from focus_metrics import focus_map
+from scan_planner import scan_planner
+from tile_triage import tile_triage
+from registration import settle_detector,estimate_shift,prepare_for_registration,load_calibrations
+from model_cache import load_cached_model
+from plate_job import plate_job
+from localizer_pipeline import preprocess_for_network,postprocess_network_output,threshold_based_on_type
+from hough_detector import hough_detector
+from target_extraction import extract_targets,get_probability_image,get_target_contours,get_target_centers
 
 num_classes = 3
 miou_metric = MeanIoU(num_classes)
@@ -21,39 +23,126 @@ mean_iou = miou_metric.mean_iou
 
 experiment_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
 
-class wellStitcher():
+# tensorflow, keras and sklearn are imported where they are used
+# so that the GUI, camera and stage can start without waiting on them
 
-	def __init__(self,box_size,initial_img):
+class wellStitcher():
+	'''
+	builds a mosaic of the well from the spiral scan. each tile is placed
+	by phase correlation against the tiles it overlaps, on a background
+	thread so the scan doesn't wait on stitching
+	'''
+	def __init__(self,box_size,initial_img,tile_step = None,stage_position = None):
 		# get our inital coordinates
 		self.box_size = int(box_size*2 + 1)
-		self.center = int(np.ceil(box_size/2)+2)
+		# grid positions run from 0 to box_size - 1 with the well centre in the middle
+		self.center = int(box_size)
 		self.curr_x = self.center
 		self.curr_y = self.center
-		# initialize the image and show it
 		self.img_x,self.img_y = int(1024),int(822)
-		self.well_img = np.zeros((self.img_y*self.box_size,self.img_x*self.box_size,3))		
-		self.stitch_img(initial_img)
+		# nominal pixel offset between neighbouring tiles, edge to edge unless told otherwise
+		if tile_step is None: tile_step = np.array([self.img_x,self.img_y])
+		self.tile_step = np.asarray(tile_step,dtype = np.float64)
+		self.origin = self.center*np.abs(self.tile_step)
+		canvas_x = int(np.ceil(abs(self.tile_step[0])*(self.box_size - 1))) + self.img_x
+		canvas_y = int(np.ceil(abs(self.tile_step[1])*(self.box_size - 1))) + self.img_y
+		self.well_img = np.zeros((canvas_y,canvas_x,3),dtype = np.uint8)
+		self.downsample = 4
+		self.min_response = .1
+		self.max_correction = 100
+		self.tiles = {}
+		self.tile_positions = []
+		self.last_grid_position = None
+		self.resized_img = None
+		# initialize the stitching worker and stitch the first image
+		self.tile_queue = queue.Queue()
+		self.worker = threading.Thread(target = self.stitch_worker,daemon = True)
+		self.worker.start()
+		self.stitch_img(initial_img,(self.curr_x,self.curr_y),stage_position)
 
 	def manage_zoom(self,pos):
 		print('trackbar at',pos)
 
-	def stitch_img(self,img):
-		self.well_img[self.curr_y*self.img_y:(self.curr_y+1)*self.img_y, self.curr_x*self.img_x:(self.curr_x+1)*self.img_x,:] = img
+	def stitch_worker(self):
+		while True:
+			grid_position,img,stage_position = self.tile_queue.get()
+			try:
+				self.stitch_img(img,grid_position,stage_position)
+			finally:
+				self.tile_queue.task_done()
+
+	def register_tile(self,small_img,grid_position):
+		'''
+		estimates the pixel position of a tile from every placed neighbour
+		it overlaps, weighting each estimate by its phase correlation response
+		'''
+		ds = self.downsample
+		estimates = []
+		weights = []
+		for dx,dy in [(-1,0),(1,0),(0,-1),(0,1)]:
+			neighbour = (grid_position[0] + dx,grid_position[1] + dy)
+			if neighbour not in self.tiles: continue
+			neighbour_position,neighbour_img = self.tiles[neighbour]
+			offset = -np.array([dx,dy])*self.tile_step
+			ox,oy = int(round(offset[0]/ds)),int(round(offset[1]/ds))
+			h,w = small_img.shape
+			overlap_x,overlap_y = w - abs(ox),h - abs(oy)
+			if overlap_x < 16 or overlap_y < 16: continue
+			a = neighbour_img[max(0,oy):max(0,oy) + overlap_y,max(0,ox):max(0,ox) + overlap_x]
+			b = small_img[max(0,-oy):max(0,-oy) + overlap_y,max(0,-ox):max(0,-ox) + overlap_x]
+			shift,response = estimate_shift(a,b,downsample = 1)
+			shift = shift*ds
+			if response < self.min_response or np.any(np.abs(shift) > self.max_correction): continue
+			# the overlap content moves by -shift when the tile sits off its nominal offset
+			estimates.append(neighbour_position + offset - shift)
+			weights.append(response)
+		if len(estimates) == 0: return None,0.
+		return np.average(estimates,axis = 0,weights = weights),float(np.max(weights))
+
+	def stitch_img(self,img,grid_position,stage_position = None):
+		small_img = prepare_for_registration(img,self.downsample)
+		position,response = self.register_tile(small_img,grid_position)
+		if position is None:
+			# nothing to register against so dead reckon from the last tile placed
+			if self.last_grid_position is None:
+				position = self.origin.copy()
+			else:
+				last_position,_ = self.tiles[self.last_grid_position]
+				position = last_position + (np.array(grid_position) - self.last_grid_position)*self.tile_step
+		self.tiles[grid_position] = (position,small_img)
+		self.last_grid_position = grid_position
+		self.tile_positions.append({'grid':list(grid_position),
+			'pixel':position.tolist(),
+			'response':response,
+			'stage':None if stage_position is None else np.asarray(stage_position).tolist()})
+		x,y = np.rint(position).astype(int)
+		x = int(np.clip(x,0,self.well_img.shape[1] - self.img_x))
+		y = int(np.clip(y,0,self.well_img.shape[0] - self.img_y))
+		self.well_img[y:y + self.img_y,x:x + self.img_x,:] = img
 		self.resized_img = cv2.resize(self.well_img,(int(1024*.8),int(822*.8)),interpolation = cv2.INTER_AREA)
-		cv2.imshow('Stitch',self.resized_img)		
 
-	def add_img(self,let,img):
+	def queue_img(self,grid_position,img,stage_position = None):
+		self.tile_queue.put((grid_position,img.copy(),stage_position))
+		if self.resized_img is not None:
+			cv2.imshow('Stitch',self.resized_img)		
+
+	def add_img(self,let,img,stage_position = None):
 		if let == 'u': self.curr_y -= 1
 		if let == 'd': self.curr_y += 1
 		if let == 'l': self.curr_x -= 1
 		if let == 'r': self.curr_x += 1
 		print(self.curr_y,self.curr_x)
-		self.stitch_img(img)
+		self.queue_img((self.curr_x,self.curr_y),img,stage_position)
 
 	def write_well_img(self):
+		# let the worker finish any tiles still waiting
+		self.tile_queue.join()
 		experiment_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'well_images')
-		cv2.imwrite(os.path.join(experiment_folder_location,
-				'{}___{}.tif'.format('well_image',now())),self.well_img)
+		os.makedirs(experiment_folder_location,exist_ok = True)
+		name = '{}___{}'.format('well_image',now())
+		cv2.imwrite(os.path.join(experiment_folder_location,name + '.tif'),self.well_img)
+		with open(os.path.join(experiment_folder_location,name + '_tiles.json'),'w') as f:
+			json.dump(self.tile_positions,f,indent = 2)
 		cv2.createTrackbar('Zoom (2^x)','Stitch',1,6,self.manage_zoom)
 
 class Localizer(QtCore.QObject):
@@ -64,13 +153,23 @@ class Localizer(QtCore.QObject):
 	ai_fire_qswitch_signal = QtCore.pyqtSignal('PyQt_PyObject')
 	start_laser_flash_signal = QtCore.pyqtSignal()
 	qswitch_screenshot_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	autofocus_signal = QtCore.pyqtSignal()
+	fire_burst_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject')
+	focus_move_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	model_status_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject')
+	targets_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject')
 
 	def __init__(self, parent = None):
 		super(Localizer, self).__init__(parent)		
+		# the model is loaded by load_models_slot once we are on our own thread
 		# self.localizer_model = load_model(os.path.join(experiment_folder_location,'multiclass_localizer18_2.hdf5'),custom_objects={'mean_iou': mean_iou})
-		self.localizer_model = load_model(os.path.join(experiment_folder_location,'model2018-10-18_08_47'),custom_objects={'mean_iou': mean_iou})
-		self.norm = StandardScaler()		
-		self.localizer_model._make_predict_function()
+		self.model_file_name = 'model2018-10-18_08_47'
+		self.localizer_model = None
+		# the model gets its own graph and session so loading it never disturbs the autofocuser's
+		self.graph = None
+		self.session = None
+		self.model_ready = False
+		self.norm = None
 		self.position = np.zeros((1,2))
 		self.well_center = np.zeros((1,2))
 		self.lysed_cell_count = 0
@@ -80,6 +179,29 @@ class Localizer(QtCore.QObject):
 		self.cell_type_to_lyse = 'red'
 		self.lysis_mode = 'direct'
 		self.auto_lysis = False		
+		self.use_focus_map = False
+		self.focus_map = None
+		self.focus_map_radius = 360
+		self.focused_position = 0
+		# objective moves sent to the autofocuser that it hasn't reported finished yet
+		self.focus_moves_pending = 0
+		self.pulses_per_cell = 3
+		self.pulse_rate = 10
+		self.pulse_times = []
+		self.settle_detector = settle_detector()
+		# 'cnn' uses the localizer network, 'hough' the classical circle detector
+		self.detector_backend = 'cnn'
+		self.hough_detector = hough_detector()
+		# set by the GUI to the video's camera_capture, so we can ask for frames grabbed after a move
+		self.capture = None
+		self.settle_times = []
+		# stage steps between neighbouring tiles of the scan
+		self.frame_distance = np.array([120,95])
+		# well geometry for the scan planner, in stage steps
+		self.well_diameter = 1320
+		self.scan_overlap = 0.
+		self.scan_pattern = 'spiral'
+		self.tile_triage = tile_triage()
 
 		# self.hallucination_img = cv2.imread(os.path.join(experiment_folder_location,'before_qswitch___06_07_2018___11.48.59.274395.tif'))
 		# img = self.get_network_output(self.hallucination_img,'binary')
@@ -89,31 +211,77 @@ class Localizer(QtCore.QObject):
 	def stop_auto_lysis(self):
 		self.auto_lysis = False
 
-	def change_type_to_lyse(self,index):
-		map_dict = {
+	def load_localizer_model(self,file_name):
+		'''
+		loads a localizer model and runs a warmup prediction so the first
+		real frame doesn't pay for building the predict function
+		'''
+		start_time = time.time()
+		self.model_ready = False
+		self.model_status_signal.emit(False,'loading localizer model...')
+		import tensorflow as tf
+		from sklearn.preprocessing import StandardScaler
+		# drop the old model's session rather than clearing the global keras one
+		if self.session is not None: self.session.close()
+		self.localizer_model,self.graph,self.session = None,None,None
+		graph = tf.Graph()
+		session = tf.Session(graph = graph)
+		with graph.as_default(),session.as_default():
+			self.localizer_model,self.model_load_metrics = load_cached_model(
+				os.path.join(experiment_folder_location,file_name),custom_objects={'mean_iou': mean_iou})
+			self.localizer_model._make_predict_function()
+		self.graph,self.session = graph,session
+		self.norm = StandardScaler()		
+		load_time = time.time() - start_time
+		with self.graph.as_default(),self.session.as_default():
+			self.localizer_model.predict(np.zeros((1,128,128,1)),batch_size = 1)
+		comment('loaded localizer model {} in {:.2f}s, warmup predict took {:.2f}s'.format(
+			file_name,load_time,time.time() - start_time - load_time))
+		self.model_ready = True
+		self.model_status_signal.emit(True,'localizer model ready')
+
+	@QtCore.pyqtSlot()
+	def load_models_slot(self):
+		'''
+		loads the model for the current cell type if the network is being
+		used. if it can't be loaded we fall back to the hough detector
+		'''
+		if self.detector_backend == 'hough':
+			self.model_status_signal.emit(True,'using the hough detector')
+			return
+		try:
+			self.load_localizer_model(self.model_file_name)
+		except (ImportError,OSError) as e:
+			# without tensorflow or the model file we can still find cells with the hough detector
+			message = 'could not load localizer model {} ({}), using the hough detector'.format(self.model_file_name,e)
+			comment(message)
+			self.detector_backend = 'hough'
+			self.model_status_signal.emit(True,message)
+
+	cell_type_models = {
 		# 0:('red','multiclass_localizer18_2.hdf5'),
 		# 1:('green','multiclass_localizer18_2.hdf5'),
 		0:('red','model2018-10-18_08_47'),
 		1:('green','model2018-10-18_08_47'),
 		2:('green hope','second_binary_green_hope_localizer_16_0.28892_1_54_7_12.hdf5')
 		}
+
+	def change_type_to_lyse(self,index):
+		map_dict = self.cell_type_models
 		self.cell_type_to_lyse = map_dict[index][0]
 		comment('loading cell localizer model...{}'.format(map_dict[index][1]))
-		self.localizer_model = None
-		K.clear_session()	
-		# TODO: remove this if statement once we have a model that doesnt need the custom object
-		if map_dict[index] != 'green hope':	
-			self.localizer_model = load_model(os.path.join(experiment_folder_location,map_dict[index][1]),custom_objects={'mean_iou': mean_iou})
-		else:
-			self.localizer_model = load_model(os.path.join(experiment_folder_location,map_dict[index][1]))
-		self.localizer_model._make_predict_function()
+		self.model_file_name = map_dict[index][1]
+		# custom_objects is only used if the model needs it, so it is safe for every model
+		self.load_models_slot()
 		comment('changed cell type to:'+str(self.cell_type_to_lyse))
 
-	def change_lysis_mode(self,index):
-		map_dict = {
+	lysis_modes = {
 		0:'direct',
 		1:'excision'
 		}
+
+	def change_lysis_mode(self,index):
+		map_dict = self.lysis_modes
 		self.lysis_mode = map_dict[index]
 		comment('changed cell type to:' + str(self.lysis_mode))
 
@@ -121,29 +289,72 @@ class Localizer(QtCore.QObject):
 		self.cells_to_lyse = number_of_cells
 		comment('set number of cells to lyse to:' + str(number_of_cells))
 
+	def set_cell_type(self,cell_type):
+		# red and green share a model, so only reload if the model changes
+		model_file_name = dict(self.cell_type_models.values())[cell_type]
+		self.cell_type_to_lyse = cell_type
+		if self.detector_backend == 'cnn' and (model_file_name != self.model_file_name or self.model_ready == False):
+			self.model_file_name = model_file_name
+			self.load_models_slot()
+		comment('changed cell type to:' + str(cell_type))
+
+	@QtCore.pyqtSlot('PyQt_PyObject')
+	def run_plate(self,job_location):
+		'''
+		runs localize on every well of a plate job that isn't finished yet,
+		checkpointing after each well so a crash resumes at the next one
+		'''
+		if self.detector_backend == 'cnn' and self.model_ready == False:
+			comment('localizer model is still loading')
+			return
+		try:
+			job = plate_job(job_location)
+		except (OSError,ValueError,KeyError) as e:
+			comment('could not read plate job {}: {!r}'.format(job_location,e))
+			return
+		# the whole job is checked before the stage moves, rather than failing at the bad well
+		problems = job.validate(set(cell_type for cell_type,_ in self.cell_type_models.values()),
+			set(self.lysis_modes.values()))
+		if len(problems) > 0:
+			comment('plate {} rejected, nothing was run: {}'.format(job.name,'; '.join(problems)))
+			return
+		remaining = job.remaining_wells()
+		comment('plate {}: {} wells to do, {} already done'.format(job.name,len(remaining),len(job.completed)))
+		for well in remaining:
+			settings = job.wells[well]
+			if settings['cell_type'] != self.cell_type_to_lyse: self.set_cell_type(settings['cell_type'])
+			self.lysis_mode = settings['lysis_mode']
+			self.set_cells_to_lyse(settings['cells_to_lyse'])
+			comment('plate {}: moving to well {}'.format(job.name,well))
+			start_time = time.time()
+			self.return_to_original_position(job.get_well_position(well))
+			self.get_stage_position()
+			self.wait_for_settle()
+			self.localize()
+			if self.auto_lysis == False:
+				comment('plate {}: stopped during well {}, it will be redone on resume'.format(job.name,well))
+				break
+			well_time = time.time() - start_time
+			stats = {'cells lysed':int(self.lysed_cell_count),
+				'tiles':self.tile_triage.tiles_checked,
+				'tiles skipped':self.tile_triage.tiles_skipped,
+				'time s':well_time,
+				'finished':now()}
+			job.mark_complete(well,stats)
+			comment('well {}: {} cells lysed over {} tiles in {:.0f}s, {:.1f} cells/min'.format(well,
+				stats['cells lysed'],stats['tiles'],well_time,60.*stats['cells lysed']/max(well_time,1e-9)))
+		comment(job.summary())
+
 	@QtCore.pyqtSlot('PyQt_PyObject')
 	def vid_process_slot(self,image):
 		self.image = image
+		self.settle_detector.update(image)
 		
 	def get_network_output(self,img,mode):
-		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)		
-		img = transform.resize(img, (128, 128), anti_aliasing=False)
-		img = self.norm.fit_transform(img)
-		img = np.expand_dims(img,axis = 4) 
-		img = np.expand_dims(img,axis = 0) 
-		with graph.as_default():
+		img = preprocess_for_network(img,self.norm)
+		with self.graph.as_default(),self.session.as_default():
 			segmented_image = self.localizer_model.predict(img,batch_size = 1)	
-		if mode == 'multi':
-			# print(segmented_image.shape)
-			return_img = np.zeros((128,128,3))
-			#red cell
-			return_img[:,:,2] = segmented_image[0,:,:,2]			
-			#green cell
-			return_img[:,:,1] = segmented_image[0,:,:,1]			
-		elif mode == 'binary':
-			return_img = segmented_image[0,:,:,0]
-		return_img = transform.resize(return_img, (125, 125), anti_aliasing=False)
-		return return_img
+		return postprocess_network_output(segmented_image,mode)
 
 	@QtCore.pyqtSlot('PyQt_PyObject')
 	def position_return_slot(self,position):
@@ -151,6 +362,81 @@ class Localizer(QtCore.QObject):
 		self.position = position.copy()
 		self.wait_for_position = False
 
+	@QtCore.pyqtSlot('PyQt_PyObject')
+	def focus_return_slot(self,position):
+		self.focused_position = position
+		self.wait_for_focus = False
+
+	def move_objective(self,position):
+		self.focus_moves_pending += 1
+		self.focus_move_signal.emit(position)
+
+	@QtCore.pyqtSlot('PyQt_PyObject')
+	def focus_move_done_slot(self,position):
+		self.focus_moves_pending = max(self.focus_moves_pending - 1,0)
+
+	def wait_for_focus_move(self,timeout = 5):
+		start_time = time.time()
+		while self.focus_moves_pending > 0:
+			QApplication.processEvents()
+			if time.time() - start_time > timeout:
+				comment('timed out waiting for the objective to reach the focus map position')
+				self.focus_moves_pending = 0
+				break
+			time.sleep(.005)
+
+	def get_focused_position(self):
+		self.wait_for_focus = True
+		self.autofocus_signal.emit()
+		while self.wait_for_focus == True:
+			QApplication.processEvents()
+			time.sleep(.1)
+		return self.focused_position
+
+	def build_focus_map(self,points_on_ring = 8):
+		'''
+		autofocuses at the well centre and at points on a ring around it, then
+		fits a focus surface over stage xy so the scan can follow it without
+		focusing on every tile
+		'''
+		start_time = time.time()
+		self.focus_map = focus_map()
+		angles = np.linspace(0,2*np.pi,points_on_ring,endpoint = False)
+		offsets = [np.zeros(2)] + [self.focus_map_radius*np.array([np.cos(angle),np.sin(angle)]) for angle in angles]
+		for offset in offsets:
+			point = np.rint(self.well_center + offset).astype(int)
+			self.localizer_move_signal.emit(point,False,False,False)
+			self.delay()
+			self.focus_map.add_point(point[0],point[1],self.get_focused_position())
+		rms_error = self.focus_map.fit()
+		self.position = self.well_center.copy()
+		self.return_to_original_position(self.well_center)
+		self.move_objective(self.focus_map.predict(self.well_center[0],self.well_center[1]))
+		comment('focus map built from {} points in {:.1f}s, rms error {:.1f} steps'.format(
+			len(offsets),time.time() - start_time,rms_error))
+
+	@QtCore.pyqtSlot('PyQt_PyObject')
+	def burst_return_slot(self,pulse_times):
+		self.pulse_times = pulse_times
+		self.wait_for_burst = False
+
+	def fire_burst(self):
+		'''
+		fires the pulses for one cell as a single burst on the laser and
+		waits until the laser reports the pulse times back
+		'''
+		start_time = time.time()
+		self.wait_for_burst = True
+		self.fire_burst_signal.emit(self.pulses_per_cell,self.pulse_rate)
+		while self.wait_for_burst == True:
+			QApplication.processEvents()
+			time.sleep(.005)
+		if len(self.pulse_times) == 0:
+			comment('burst failed, no pulses were fired at this cell')
+		else:
+			comment('cell fire time: {:.3f}s'.format(time.time() - start_time))
+		return self.pulse_times
+
 	def get_stage_position(self):		
 		self.wait_for_position = True
 		while self.wait_for_position == True:
@@ -160,8 +446,7 @@ class Localizer(QtCore.QObject):
 		return self.position
 
 	def move_frame(self,direction,relative=True):
-		y_distance = 95
-		x_distance = 120
+		x_distance,y_distance = self.frame_distance
 		frame_dir_dict = {
 		'u': np.array([0,-y_distance]),
 		'd': np.array([0,y_distance]),
@@ -169,22 +454,49 @@ class Localizer(QtCore.QObject):
 		'r': np.array([x_distance,0])
 		}
 		self.localizer_move_signal.emit(frame_dir_dict[direction],False,True,False)
+		# keep track of where we expect to be so the objective can move with the stage
+		self.position = self.position + frame_dir_dict[direction]
+		if self.use_focus_map == True and self.focus_map is not None:
+			self.move_objective(self.focus_map.predict(self.position[0],self.position[1]))
+
+	def get_tile_step(self,tile_spacing = None):
+		'''
+		pixel offset between neighbouring scan tiles from the 4x stage
+		calibration, or None to lay the tiles edge to edge. tile_spacing is
+		in stage steps and defaults to the frame distance
+		'''
+		calibrations = load_calibrations()
+		if 4 not in calibrations: return None
+		if tile_spacing is None: tile_spacing = self.frame_distance
+		pixel_per_step = np.linalg.inv(calibrations[4][:,:2])
+		step_x = pixel_per_step.dot([tile_spacing[0],0])
+		step_y = pixel_per_step.dot([0,tile_spacing[1]])
+		return np.array([step_x[0],step_y[1]])
+
+	def move_to_waypoint(self,waypoint):
+		self.localizer_move_signal.emit(waypoint,False,False,False)
+		self.position = np.array(waypoint)
+		if self.use_focus_map == True and self.focus_map is not None:
+			self.move_objective(self.focus_map.predict(self.position[0],self.position[1]))
 
 	def return_to_original_position(self,position):				
 		self.localizer_move_signal.emit(position,False,False,False)
 
 	@QtCore.pyqtSlot()
 	def localize2(self):
+		# only tiles the well, so it needs no localizer model
 		box_size = 5
 		self.well_center = self.get_stage_position()		
-		stitcher = wellStitcher(box_size,self.image)		
+		if self.use_focus_map == True:
+			self.build_focus_map()
+			self.wait_for_settle()
+		stitcher = wellStitcher(box_size,self.image,self.get_tile_step(),self.well_center)		
 		directions = self.get_spiral_directions(box_size)	
 		for num,let in directions:
-			self.delay()
-			self.move_frame(let)				
-			self.delay()
-			QApplication.processEvents()
-			stitcher.add_img(let,self.image)
+			for i in range(num):
+				self.move_frame(let)				
+				self.wait_for_settle()
+				stitcher.add_img(let,self.image,self.position)
 		comment('writing well tile file...')
 		stitcher.write_well_img()
 		comment('tiling completed!')			
@@ -196,37 +508,58 @@ class Localizer(QtCore.QObject):
 		using the method of lysis that the user selects, then returns to the original
 		position (the center of the well)
 		'''
+		if self.detector_backend == 'cnn' and self.model_ready == False:
+			comment('localizer model is still loading')
+			return
 		# first get our well center position		
 		self.lysed_cell_count = 0
+		self.settle_times = []
+		self.tile_triage.reset()
 		self.auto_lysis = True
 		self.well_center = self.get_stage_position()		
-		# now start moving and lysing all in view
-		self.lyse_all_in_view()
-		box_size = 5
-		# stitcher = wellStitcher(box_size,self.image)		
-		directions = self.get_spiral_directions(box_size)		
+		if self.use_focus_map == True:
+			self.build_focus_map()
+			# build_focus_map ends by moving back to the centre and its mapped focus
+			self.wait_for_settle()
+		planner = scan_planner(self.well_center,self.well_diameter,self.frame_distance,
+			self.scan_overlap,self.scan_pattern)
+		comment('scan plan: {}'.format(planner.summary()))
+		# we start at the well centre, so it is imaged first and left out of the plan.
+		# only the spiral starts there, the serpentine's first tile is a corner
+		center_image = self.lyse_all_in_view()
 		self.get_well_center = False
-		for num,let in directions:
-			for i in range(num):
-				if self.auto_lysis == False:
-					self.stop_laser_flash_signal.emit()	
-					return
-				if self.lysed_cell_count >= self.cells_to_lyse: 
-					self.delay()
-					self.return_to_original_position(self.well_center)
-					return	
-				self.delay()
-				self.move_frame(let)				
-				self.delay()
-				QApplication.processEvents()
-				self.delay()
-				QApplication.processEvents()
-				# stitcher.add_img(let,self.image)
-				self.lyse_all_in_view()
+		# tiles are stitched on a background thread as the scan goes
+		stitcher = wellStitcher(planner.rings,center_image,self.get_tile_step(planner.tile_spacing),self.well_center)
+		waypoints = [waypoint for waypoint in planner.waypoints if not np.allclose(waypoint,self.well_center)]
+		for waypoint in waypoints:
+			if self.auto_lysis == False:
+				self.stop_laser_flash_signal.emit()	
+				self.finish_scan(stitcher)
+				return
+			if self.lysed_cell_count >= self.cells_to_lyse: 
+				self.finish_scan(stitcher)
+				self.return_to_original_position(self.well_center)
+				return	
+			self.move_to_waypoint(waypoint)				
+			self.wait_for_settle()
+			tile_image = self.lyse_all_in_view()
+			grid_offset = np.rint((waypoint - self.well_center)/planner.tile_spacing).astype(int)
+			stitcher.queue_img((stitcher.center + grid_offset[0],stitcher.center + grid_offset[1]),tile_image,waypoint)
 		comment('lysis completed!')
-		# stitcher.write_well_img()
+		self.finish_scan(stitcher)
 		self.return_to_original_position(self.well_center)
 
+	def finish_scan(self,stitcher):
+		comment('tile triage: {}'.format(self.tile_triage.summary()))
+		# a well that fits in one tile has no moves to report
+		if len(self.settle_times) > 0:
+			comment('settle times: mean {:.3f}s max {:.3f}s over {} moves'.format(
+				np.mean(self.settle_times),np.max(self.settle_times),len(self.settle_times)))
+		else:
+			comment('settle times: no moves')
+		comment('writing well tile file...')
+		stitcher.write_well_img()
+
 
 	def get_spiral_directions(self,box_size):
 	    letters = ['u', 'l', 'd', 'r']
@@ -245,16 +578,79 @@ class Localizer(QtCore.QObject):
 	def delay(self):
 		time.sleep(self.delay_time)
 
+	def wait_for_settle(self,still_frames = 2,motion_timeout = .3,timeout = 3):
+		'''
+		waits until the field of view has stopped moving. if no motion is
+		seen within motion_timeout we assume the move already finished.
+		the settle detector only sees xy motion, so any objective move to
+		the focus map is waited for first
+		'''
+		self.wait_for_focus_move()
+		start_time = time.time()
+		seen_motion = False
+		still_count = 0
+		last_count = self.settle_detector.frame_count
+		while True:
+			QApplication.processEvents()
+			elapsed = time.time() - start_time
+			if elapsed > timeout:
+				comment('timed out waiting for the stage to settle')
+				break
+			if self.settle_detector.frame_count == last_count:
+				time.sleep(.005)
+				continue
+			last_count = self.settle_detector.frame_count
+			if self.settle_detector.is_moving():
+				seen_motion = True
+				still_count = 0
+			else:
+				still_count += 1
+			if still_count >= still_frames and (seen_motion or elapsed > motion_timeout): break
+		settle_time = time.time() - start_time
+		self.settle_times.append(settle_time)
+		comment('settled in {:.3f}s'.format(settle_time))
+		return settle_time
+
+	def get_fresh_image(self,after_time):
+		'''
+		returns a frame grabbed after after_time, rather than the last frame
+		the video thread happened to pass on
+		'''
+		if self.capture is None: return self.image
+		frame,frame_time = self.capture.get_frame_after(after_time)
+		if frame is None:
+			comment('no fresh frame from the camera, using the last video frame')
+			return self.image
+		return frame
+
 	def lyse_all_in_view(self):
 		'''
 		gets initial position lyses all cells in view, and then
-		returns to initial position
+		returns to initial position. tiles that can't contain cells are
+		skipped before the network is run. the caller waits for the stage
+		to settle after moving here. returns the image of the tile, taken
+		before any lysis
 		'''
-		self.start_laser_flash_signal.emit()
 		view_center = self.get_stage_position()		
 		print('lysing all in view...')
-		self.delay()
-		if self.cell_type_to_lyse == 'green hope':
+		self.image = self.get_fresh_image(time.time())
+		process,contrast,channel_excess = self.tile_triage.should_process(self.image,self.cell_type_to_lyse)
+		comment('tile triage: contrast {:.2f}, channel excess {:.2f}, {}'.format(
+			contrast,channel_excess,'processing' if process else 'skipping'))
+		# self.image keeps following the video while we lyse
+		tile_image = self.image
+		if not process: return tile_image
+		start_time = time.time()
+		self.lyse_tile(view_center)
+		self.tile_triage.add_processing_time(time.time() - start_time)
+		return tile_image
+
+	def lyse_tile(self,view_center):
+		self.start_laser_flash_signal.emit()
+		if self.detector_backend == 'hough':
+			targets,labels = self.hough_detector.detect(self.image,self.cell_type_to_lyse)
+			self.lyse_targets(targets,labels,self.lysis_mode)
+		elif self.cell_type_to_lyse == 'green hope':
 			segmented_image = self.get_network_output(self.image,'binary')
 			self.lyse_cells(segmented_image,self.cell_type_to_lyse,self.lysis_mode)
 		else:
@@ -283,17 +679,23 @@ class Localizer(QtCore.QObject):
 		upon the input parameters
 		'''
 		confidence_image = self.threshold_based_on_type(segmented_image,cell_type)
+		targets,labels = extract_targets(confidence_image,
+			get_probability_image(segmented_image,cell_type),cell_type)
+		self.lyse_targets(targets,labels,lyse_type)
 
-		cell_contours,cell_centers = self.get_contours_and_centers(confidence_image)
+	def lyse_targets(self,targets,labels,lyse_type):
+		# drawn over the video by the main viewer
+		self.targets_signal.emit(targets,labels.shape)
 
-		if len(cell_centers) == 0:
+		if len(targets) == 0:
 			print('NO CELLS FOUND')
 			return
 
 		if lyse_type == 'direct':
-			self.direct_lysis(cell_centers)
+			self.direct_lysis(get_target_centers(targets))
 		elif lyse_type == 'excision':			
-			self.excision_lysis(cell_contours)
+			# contours are only traced when we are going to cut around them
+			self.excision_lysis(get_target_contours(targets,labels))
 
 	def excision_lysis(self,cell_contours):
 		# for each contour we want to trace it
@@ -350,12 +752,10 @@ class Localizer(QtCore.QObject):
 		print('centers:',cell_centers)
 		old_center = cell_centers[0]
 		self.move_to_target(old_center-window_center,True)
-		self.delay()
+		self.wait_for_settle()
 		self.qswitch_screenshot_signal.emit(10)
-		for i in range(3):
-			self.ai_fire_qswitch_signal.emit(False)
-			self.delay()
-		self.lysed_cell_count += 1
+		# a cell only counts as lysed if the burst actually fired
+		if len(self.fire_burst()) > 0: self.lysed_cell_count += 1
 		if self.lysed_cell_count >= self.cells_to_lyse: 				
 				self.return_to_original_position(self.well_center)
 				self.stop_laser_flash_signal.emit()	
@@ -365,12 +765,8 @@ class Localizer(QtCore.QObject):
 				self.qswitch_screenshot_signal.emit(15)
 				self.move_to_target(-old_center + cell_centers[i],False)
 				old_center = cell_centers[i]				
-				self.delay()
-				for i in range(3):	
-					self.ai_fire_qswitch_signal.emit(False)
-					self.delay()
-				self.delay()
-				self.lysed_cell_count += 1
+				self.wait_for_settle()
+				if len(self.fire_burst()) > 0: self.lysed_cell_count += 1
 				if self.auto_lysis == False:
 					self.stop_laser_flash_signal.emit()	
 					return
@@ -380,40 +776,14 @@ class Localizer(QtCore.QObject):
 					self.stop_laser_flash_signal.emit()	
 					return	
 
-	def get_contours_and_centers(self,confidence_image):
-		_, contours, _ = cv2.findContours(np.uint8(confidence_image), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-		cell_image = np.zeros((125,125))
-		cell_contours = []
-		cell_centers = []
-		for contour in contours:
-			# print(cv2.contourArea(contour))
-			if cv2.contourArea(contour) > 20:
-				(x,y),radius = cv2.minEnclosingCircle(contour)
-				center = (int(x),int(y))
-				cell_contours.append(contour)				
-				cv2.circle(cell_image,center,2 ,(255,0,0),-1)
-				center = np.array(center)
-				cell_centers.append(center)
-		cv2.drawContours(cell_image, contours, -1, (255,255,255), 1)
-		cv2.imshow('Cell Outlines and Centers',cell_image)
-		return cell_contours,cell_centers				
-
 	def threshold_based_on_type(self,segmented_image,cell_type):
-		if cell_type == 'green':
-			_,confidence_image = cv2.threshold(segmented_image[:,:,1],.9,1,cv2.THRESH_BINARY)
-		elif cell_type == 'red':
-			_,confidence_image = cv2.threshold(segmented_image[:,:,2],.9,1,cv2.THRESH_BINARY)
-		elif cell_type == 'green hope':
-			# assumes a binary image!
-			# TODO: find the optimal location on the AUC curve for the threshold
-			_,confidence_image = cv2.threshold(segmented_image,.9,1,cv2.THRESH_BINARY)
-		return confidence_image
+		return threshold_based_on_type(segmented_image,cell_type)
 
 	def move_to_target(self,center,goto_reticle = False):
-		# we need to scale our centers up to the proper resolution and then 
+		# we need to scale our centers up to camera pixels and then 
 		# send it to the stage
-		x = center[0]*851/125
-		y = center[1]*681/125
+		x = center[0]*1024/125
+		y = center[1]*822/125
 		self.localizer_move_signal.emit(np.array([x,y]),goto_reticle,True,True)
 
 
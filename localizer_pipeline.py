@@ -0,0 +1,46 @@
+'''
+the localizer's image pipeline around the network: preprocessing, turning
+the network output into per-cell images, and thresholding. kept free of Qt
+and of the hardware so it can run headless, see batch_localize.py
+'''
+import cv2
+import numpy as np
+# skimage is imported inside the functions, the GUI imports this module at startup
+
+def get_network_mode(cell_type):
+	# the green hope model is binary, the others output a channel per cell type
+	return 'binary' if cell_type == 'green hope' else 'multi'
+
+def preprocess_for_network(img,norm):
+	import skimage.transform as transform
+	img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)		
+	img = transform.resize(img, (128, 128), anti_aliasing=False)
+	img = norm.fit_transform(img)
+	img = np.expand_dims(img,axis = -1) 
+	img = np.expand_dims(img,axis = 0) 
+	return img
+
+def postprocess_network_output(segmented_image,mode):
+	import skimage.transform as transform
+	if mode == 'multi':
+		# print(segmented_image.shape)
+		return_img = np.zeros((128,128,3))
+		#red cell
+		return_img[:,:,2] = segmented_image[0,:,:,2]			
+		#green cell
+		return_img[:,:,1] = segmented_image[0,:,:,1]			
+	elif mode == 'binary':
+		return_img = segmented_image[0,:,:,0]
+	return_img = transform.resize(return_img, (125, 125), anti_aliasing=False)
+	return return_img
+
+def threshold_based_on_type(segmented_image,cell_type):
+	if cell_type == 'green':
+		_,confidence_image = cv2.threshold(segmented_image[:,:,1],.9,1,cv2.THRESH_BINARY)
+	elif cell_type == 'red':
+		_,confidence_image = cv2.threshold(segmented_image[:,:,2],.9,1,cv2.THRESH_BINARY)
+	elif cell_type == 'green hope':
+		# assumes a binary image!
+		# TODO: find the optimal location on the AUC curve for the threshold
+		_,confidence_image = cv2.threshold(segmented_image,.9,1,cv2.THRESH_BINARY)
+	return confidence_image
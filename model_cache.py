@@ -0,0 +1,112 @@
+'''
+keeps a fast-loading copy of each keras model next to the original file.
+the architecture is stored as json and the weights as an uncompressed npz,
+both named after a hash of the original so a retrained model with the same
+name is never loaded from a stale cache. loading from the cache skips
+parsing the hdf5 file and compiling the model, which inference doesn't need.
+
+the first load of a model converts it, or all the models can be converted
+up front with:
+
+	python model_cache.py
+'''
+import os,sys,glob,time,json,hashlib,logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+def comment(text):
+	# not utils.comment, which would give every headless batch_localize.py run an
+	# experiment folder. in the GUI the experiment log picks this up through logging
+	print(text)
+	log.info(text)
+
+models_folder_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'models')
+
+def get_file_hash(file_location,chunk_size = 1 << 20):
+	sha = hashlib.sha1()
+	with open(file_location,'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size),b''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+def get_cache_locations(file_location,file_hash):
+	base = '{}.{}.cache'.format(file_location,file_hash[:16])
+	return base + '.json',base + '.npz'
+
+def remove_stale_caches(file_location,file_hash):
+	current = get_cache_locations(file_location,file_hash)
+	for cache_location in glob.glob(glob.escape(file_location) + '.*.cache.*'):
+		if cache_location not in current:
+			os.remove(cache_location)
+
+def convert_model(model,file_location,file_hash = None):
+	'''
+	writes the cached form of a loaded model. files are written under a
+	temporary name first so an interrupted conversion is never picked up
+	'''
+	if file_hash is None: file_hash = get_file_hash(file_location)
+	json_location,weights_location = get_cache_locations(file_location,file_hash)
+	with open(json_location + '.tmp','w') as f:
+		f.write(model.to_json())
+	with open(weights_location + '.tmp','wb') as f:
+		np.savez(f,*model.get_weights())
+	os.replace(weights_location + '.tmp',weights_location)
+	os.replace(json_location + '.tmp',json_location)
+	remove_stale_caches(file_location,file_hash)
+	return json_location,weights_location
+
+def load_cached_model(file_location,custom_objects = None,convert = True,compile = True):
+	'''
+	loads a keras model from its cached form when there is one for the
+	current contents of the file, otherwise from the file itself, converting
+	it for the next time. returns the model and a dict of load timings.
+	compile = False loads an hdf5 file without its custom metrics
+	'''
+	from keras.models import load_model,model_from_json
+	start_time = time.time()
+	file_hash = get_file_hash(file_location)
+	hash_time = time.time() - start_time
+	json_location,weights_location = get_cache_locations(file_location,file_hash)
+	if os.path.exists(json_location) and os.path.exists(weights_location):
+		source = 'cache'
+		with open(json_location,'r') as f:
+			model = model_from_json(f.read(),custom_objects = custom_objects)
+		with np.load(weights_location) as weights:
+			model.set_weights([weights['arr_{}'.format(i)] for i in range(len(weights.files))])
+	else:
+		source = 'hdf5'
+		model = load_model(file_location,custom_objects = custom_objects,compile = compile)
+	load_time = time.time() - start_time - hash_time
+	metrics = {'file':os.path.basename(file_location),
+		'source':source,
+		'hash':file_hash,
+		'hash s':hash_time,
+		'load s':load_time}
+	if source == 'hdf5' and convert == True:
+		convert_model(model,file_location,file_hash)
+		metrics['convert s'] = time.time() - start_time - hash_time - load_time
+	comment('loaded {} from {} in {:.2f}s (hash {:.2f}s)'.format(metrics['file'],
+		source,load_time,hash_time))
+	return model,metrics
+
+if __name__ == '__main__':
+	# the localizer models were trained with the mean_iou metric, the rest load without it
+	from iou_metrics import MeanIoU
+	custom_objects = {'mean_iou':MeanIoU(3).mean_iou}
+	file_locations = sys.argv[1:] if len(sys.argv) > 1 else sorted(glob.glob(os.path.join(models_folder_location,'*.hdf5')))
+	results = []
+	for file_location in file_locations:
+		from keras import backend as K
+		K.clear_session()
+		model,metrics = load_cached_model(file_location,custom_objects)
+		if metrics['source'] == 'hdf5':
+			# time the cached load straight away so the speedup can be checked
+			K.clear_session()
+			model,cached_metrics = load_cached_model(file_location,custom_objects)
+			metrics['cached load s'] = cached_metrics['load s']
+		results.append(metrics)
+	for metrics in results:
+		print('{:<60} hdf5 {:>8} cache {:>8}'.format(metrics['file'],
+			'{:.2f}s'.format(metrics['load s']) if metrics['source'] == 'hdf5' else '-',
+			'{:.2f}s'.format(metrics.get('cached load s',metrics['load s']))))
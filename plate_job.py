@@ -0,0 +1,89 @@
+import os,json,time
+import numpy as np
+
+class plate_job():
+	'''
+	a plate layout with settings for each well, plus a checkpoint of the
+	wells that are finished so an interrupted plate resumes at the next
+	well. the job file looks like:
+
+		{"name":"plate_1",
+		"a1_position":[12000,-3000],
+		"well_spacing":[4400,4400],
+		"defaults":{"cell_type":"red","lysis_mode":"direct","cells_to_lyse":5},
+		"wells":{"A1":{},"A2":{"cells_to_lyse":10},"B1":{"cell_type":"green"}}}
+
+	positions are stage steps, the spacing is signed to match the stage axes.
+	wells are visited row by row in a serpentine
+	'''
+	def __init__(self,job_location):
+		with open(job_location,'r') as f:
+			job = json.load(f)
+		self.name = job.get('name',os.path.splitext(os.path.basename(job_location))[0])
+		self.a1_position = np.array(job['a1_position'])
+		self.well_spacing = np.array(job.get('well_spacing',[4400,4400]))
+		defaults = {'cell_type':'red','lysis_mode':'direct','cells_to_lyse':5}
+		defaults.update(job.get('defaults',{}))
+		self.wells = {}
+		for well,settings in job['wells'].items():
+			self.wells[well.upper()] = dict(defaults,**settings)
+		self.checkpoint_location = os.path.splitext(job_location)[0] + '_checkpoint.json'
+		self.completed = {}
+		if os.path.exists(self.checkpoint_location):
+			with open(self.checkpoint_location,'r') as f:
+				self.completed = json.load(f)
+
+	def validate(self,cell_types,lysis_modes):
+		'''
+		returns a list of problems with the job's wells, empty if every
+		well can be run. checked before the plate starts so a bad entry
+		can't stop it halfway through
+		'''
+		problems = []
+		for well,settings in sorted(self.wells.items()):
+			if len(well) < 2 or not 'A' <= well[0] <= 'Z' or not well[1:].isdigit() or int(well[1:]) < 1:
+				problems.append('{}: not a well name'.format(well))
+			if settings['cell_type'] not in cell_types:
+				problems.append('{}: unknown cell_type {!r}, expected one of {}'.format(well,settings['cell_type'],sorted(cell_types)))
+			if settings['lysis_mode'] not in lysis_modes:
+				problems.append('{}: unknown lysis_mode {!r}, expected one of {}'.format(well,settings['lysis_mode'],sorted(lysis_modes)))
+			cells_to_lyse = settings['cells_to_lyse']
+			if isinstance(cells_to_lyse,bool) or not isinstance(cells_to_lyse,(int,float)) or cells_to_lyse < 0:
+				problems.append('{}: cells_to_lyse must be a number of cells, got {!r}'.format(well,cells_to_lyse))
+		return problems
+
+	def get_grid_position(self,well):
+		return ord(well[0]) - ord('A'),int(well[1:]) - 1
+
+	def get_well_position(self,well):
+		row,column = self.get_grid_position(well)
+		return np.rint(self.a1_position + self.well_spacing*np.array([column,row])).astype(int)
+
+	def get_well_order(self):
+		def key(well):
+			row,column = self.get_grid_position(well)
+			return row,column if row % 2 == 0 else -column
+		return sorted(self.wells.keys(),key = key)
+
+	def remaining_wells(self):
+		return [well for well in self.get_well_order() if well not in self.completed]
+
+	def mark_complete(self,well,stats):
+		'''
+		records a finished well. the checkpoint is replaced in one step so a
+		crash while writing never loses the wells already done
+		'''
+		self.completed[well] = stats
+		with open(self.checkpoint_location + '.tmp','w') as f:
+			json.dump(self.completed,f,indent = 2)
+		os.replace(self.checkpoint_location + '.tmp',self.checkpoint_location)
+
+	def summary(self):
+		stats = list(self.completed.values())
+		total_time = sum(s['time s'] for s in stats)
+		cells = sum(s['cells lysed'] for s in stats)
+		tiles = sum(s['tiles'] for s in stats)
+		hours = max(total_time/3600.,1e-9)
+		return '{}: {} of {} wells done in {:.0f}s, {} cells lysed over {} tiles, {:.1f} wells/h, {:.0f} cells/h'.format(
+			self.name,len(stats),len(self.wells),total_time,cells,tiles,
+			len(stats)/hours,cells/hours)
@@ -0,0 +1,75 @@
+import os,json
+import cv2
+import numpy as np
+
+calibration_file_location = os.path.join(os.path.dirname(os.path.abspath(__file__)),'stage_calibration.json')
+
+def prepare_for_registration(img,downsample = 2):
+	if img.ndim == 3:
+		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+	if downsample > 1:
+		img = cv2.resize(img,(img.shape[1]//downsample,img.shape[0]//downsample),interpolation = cv2.INTER_AREA)
+	return img.astype(np.float32)
+
+def estimate_shift(img_a,img_b,downsample = 2):
+	'''
+	estimates how far the content of img_b has moved relative to img_a, in
+	full resolution pixels, by phase correlation on downsampled images.
+	also returns the phase correlation response as a confidence measure
+	'''
+	a = prepare_for_registration(img_a,downsample)
+	b = prepare_for_registration(img_b,downsample)
+	window = cv2.createHanningWindow((a.shape[1],a.shape[0]), cv2.CV_32F)
+	(dx,dy),response = cv2.phaseCorrelate(a,b,window)
+	return np.array([dx,dy])*downsample,response
+
+def fit_pixel_to_stage(pixel_vectors,stage_moves):
+	'''
+	least squares fit of stage = A.dot(pixel), returned as a 2x2 matrix
+	along with the rms error of the fit in stage steps. these are
+	displacements, so there is no offset, a zero move is zero steps
+	'''
+	pixels = np.asarray(pixel_vectors,dtype = np.float64)
+	moves = np.asarray(stage_moves,dtype = np.float64)
+	solution,_,_,_ = np.linalg.lstsq(pixels,moves,rcond = None)
+	residuals = moves - pixels.dot(solution)
+	return solution.T,float(np.sqrt(np.mean(residuals**2)))
+
+def apply_transform(transform,pixel_vector):
+	# older calibrations were fitted with an offset column, it is ignored
+	return transform[:,:2].dot(pixel_vector)
+
+def load_calibrations():
+	'''
+	returns the stored pixel to stage transforms keyed by magnification
+	'''
+	if not os.path.exists(calibration_file_location): return {}
+	with open(calibration_file_location,'r') as f:
+		stored = json.load(f)
+	return {int(mag):np.array(transform) for mag,transform in stored.items()}
+
+def save_calibrations(calibrations):
+	with open(calibration_file_location,'w') as f:
+		json.dump({str(mag):transform.tolist() for mag,transform in calibrations.items()},f,indent = 2)
+
+class settle_detector():
+	'''
+	compares consecutive frames at low resolution to tell when the field
+	of view has stopped moving after a stage move
+	'''
+	def __init__(self,threshold = 2.,downsample = 8):
+		self.threshold = threshold
+		self.downsample = downsample
+		self.previous = None
+		self.difference = 0.
+		self.frame_count = 0
+
+	def update(self,img):
+		small = prepare_for_registration(img,self.downsample)
+		if self.previous is not None:
+			self.difference = float(np.mean(cv2.absdiff(small,self.previous)))
+		self.previous = small
+		self.frame_count += 1
+
+	def is_moving(self):
+		return self.difference > self.threshold
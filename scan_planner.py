@@ -0,0 +1,65 @@
+import numpy as np
+
+class scan_planner():
+	'''
+	plans the tiles to image in a round well as absolute stage waypoints,
+	skipping tiles whose field of view falls completely outside the well.
+	all distances are in stage steps
+	'''
+	def __init__(self,well_center,well_diameter,fov_size,overlap = 0.,pattern = 'spiral'):
+		self.well_center = np.asarray(well_center,dtype = np.float64).reshape(2)
+		self.well_radius = well_diameter/2.
+		self.fov_size = np.asarray(fov_size,dtype = np.float64)
+		self.tile_spacing = self.fov_size*(1 - overlap)
+		self.pattern = pattern
+		self.waypoints = self.plan()
+
+	def tile_in_well(self,offset):
+		# the closest point of the field of view to the well centre must be inside the well
+		closest = np.maximum(np.abs(offset) - self.fov_size/2,0)
+		return np.hypot(closest[0],closest[1]) <= self.well_radius
+
+	def get_spiral_offsets(self,rings):
+		# walks the same up, left, down, right square spiral as the localizer
+		offsets = [(0,0)]
+		x,y = 0,0
+		letter_steps = {'u':(0,-1),'l':(-1,0),'d':(0,1),'r':(1,0)}
+		for i in range(1,2*rings + 2,2):
+			for num,let in [(i,'u'),(i,'l'),(i + 1,'d'),(i + 1,'r')]:
+				for j in range(num):
+					x,y = x + letter_steps[let][0],y + letter_steps[let][1]
+					if max(abs(x),abs(y)) <= rings: offsets.append((x,y))
+		return offsets
+
+	def get_serpentine_offsets(self,rings):
+		offsets = []
+		for row,y in enumerate(range(-rings,rings + 1)):
+			xs = range(-rings,rings + 1)
+			if row % 2 == 1: xs = reversed(xs)
+			offsets += [(x,y) for x in xs]
+		return offsets
+
+	def plan(self):
+		rings = int(np.ceil(np.max(self.well_radius/self.tile_spacing)))
+		# tiles are at most this many grid steps from the centre in x or y
+		self.rings = rings
+		if self.pattern == 'serpentine':
+			grid_offsets = self.get_serpentine_offsets(rings)
+		else:
+			grid_offsets = self.get_spiral_offsets(rings)
+		offsets = [np.array(offset)*self.tile_spacing for offset in grid_offsets]
+		offsets = [offset for offset in offsets if self.tile_in_well(offset)]
+		return np.rint(self.well_center + np.array(offsets)).astype(int)
+
+	def estimate_scan_time(self,stage_speed = 1000.,time_per_tile = 1.):
+		'''
+		time to travel between the waypoints at stage_speed (steps/s) plus
+		a fixed settle and processing time at each tile
+		'''
+		path = np.vstack([self.well_center,self.waypoints,self.well_center])
+		distance = np.sum(np.max(np.abs(np.diff(path,axis = 0)),axis = 1))
+		return distance/stage_speed + len(self.waypoints)*time_per_tile
+
+	def summary(self,stage_speed = 1000.,time_per_tile = 1.):
+		return '{} scan of {} tiles, estimated {:.0f}s'.format(self.pattern,
+			len(self.waypoints),self.estimate_scan_time(stage_speed,time_per_tile))
@@ -0,0 +1,162 @@
+'''
+continuous recording of the raw camera frames to a compressed video, with
+sidecar files mapping frame numbers to what happened during the session:
+
+	session.avi            the frames, encoded on a background thread
+	session.frames.csv     frame number and grab time of every frame
+	session.events.jsonl   one event per line, qswitch fires, stage moves
+	                       and comments, each with the frame it happened on
+
+list a session's events, or save the frames around them, with:
+
+	python session_recorder.py <experiment folder> --kind qswitch --extract out
+'''
+import os,sys,json,time,bisect,argparse,threading,queue
+from collections import deque
+import cv2
+
+# the recorder events go to, set while a session is being recorded
+active_recorder = None
+
+def record_event(kind,text = '',event_time = None):
+	'''
+	adds an event to the active recording, does nothing if there is none
+	'''
+	recorder = active_recorder
+	if recorder is not None: recorder.add_event(kind,text,event_time)
+
+class session_recorder():
+	'''
+	frames are queued by the video thread and written by an encoder thread,
+	so encoding never holds up the display. if the encoder falls behind by
+	more than max_queue frames new frames are dropped, and frame numbers
+	only count the frames that get written
+	'''
+	def __init__(self,folder_location,name = 'session',fps = 14.,fourcc = 'MJPG',max_queue = 30,
+		time_window = 1000):
+		self.video_location = os.path.join(folder_location,name + '.avi')
+		self.frames_location = os.path.join(folder_location,name + '.frames.csv')
+		self.events_location = os.path.join(folder_location,name + '.events.jsonl')
+		self.fps = fps
+		self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+		self.queue = queue.Queue(max_queue)
+		self.lock = threading.Lock()
+		self.frame_count = 0
+		self.dropped_frames = 0
+		self.event_count = 0
+		# grab times of the last frames, so events reported after the fact land on the right frame
+		self.frame_times = deque(maxlen = time_window)
+		self.writer = None
+		self.encode_time = 0.
+		self.running = False
+
+	def start(self):
+		global active_recorder
+		self.events_file = open(self.events_location,'a')
+		self.running = True
+		self.thread = threading.Thread(target = self.encode_loop,daemon = True)
+		self.thread.start()
+		active_recorder = self
+
+	def stop(self):
+		global active_recorder
+		if active_recorder is self: active_recorder = None
+		self.running = False
+		self.queue.put(None)
+		self.thread.join()
+		with self.lock:
+			self.events_file.close()
+
+	def add_frame(self,frame,frame_time = None):
+		'''
+		queues a frame for encoding without waiting. the frame is not copied,
+		so it must not be drawn on afterwards
+		'''
+		if not self.running: return
+		if frame_time is None: frame_time = time.time()
+		with self.lock:
+			try:
+				self.queue.put_nowait((self.frame_count,frame_time,frame))
+			except queue.Full:
+				self.dropped_frames += 1
+				return
+			self.frame_times.append(frame_time)
+			self.frame_count += 1
+
+	def get_frame_number(self,event_time):
+		# the last frame grabbed at or before event_time
+		first_frame = self.frame_count - len(self.frame_times)
+		return max(first_frame + bisect.bisect_right(self.frame_times,event_time) - 1,0)
+
+	def add_event(self,kind,text = '',event_time = None):
+		if event_time is None: event_time = time.time()
+		with self.lock:
+			if self.events_file.closed: return
+			event = {'frame':self.get_frame_number(event_time),'time':event_time,'kind':kind,'text':text}
+			self.events_file.write(json.dumps(event) + '\n')
+			# flushed so the index is usable even if the session crashes
+			self.events_file.flush()
+			self.event_count += 1
+
+	def encode_loop(self):
+		with open(self.frames_location,'a') as frames_file:
+			while True:
+				item = self.queue.get()
+				if item is None: break
+				frame_number,frame_time,frame = item
+				start_time = time.perf_counter()
+				if self.writer is None:
+					height,width = frame.shape[:2]
+					self.writer = cv2.VideoWriter(self.video_location,self.fourcc,self.fps,(width,height))
+				self.writer.write(frame)
+				frames_file.write('{},{:.6f}\n'.format(frame_number,frame_time))
+				self.encode_time += time.perf_counter() - start_time
+		if self.writer is not None: self.writer.release()
+
+	def summary(self):
+		encoded = self.frame_count - self.queue.qsize()
+		return 'session recording: {} frames ({} dropped), {} events, {:.1f} ms per frame encoding, {:.1f} MB'.format(
+			self.frame_count,self.dropped_frames,self.event_count,1000*self.encode_time/max(encoded,1),
+			os.path.getsize(self.video_location)/1e6 if os.path.exists(self.video_location) else 0)
+
+def load_events(events_location,kind = None):
+	with open(events_location,'r') as f:
+		events = [json.loads(line) for line in f if line.strip() != '']
+	return [event for event in events if kind is None or event['kind'] == kind]
+
+def read_frames(video_location,first_frame,num_frames = 1):
+	'''
+	reads num_frames frames starting at first_frame, seeking rather than
+	decoding everything before it
+	'''
+	video = cv2.VideoCapture(video_location)
+	video.set(cv2.CAP_PROP_POS_FRAMES,first_frame)
+	frames = []
+	for i in range(num_frames):
+		ret,frame = video.read()
+		if not ret: break
+		frames.append(frame)
+	video.release()
+	return frames
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('folder',help = 'experiment folder the session was recorded in')
+	parser.add_argument('--name',default = 'session')
+	parser.add_argument('--kind',help = 'only show events of this kind, eg qswitch, stage_move or comment')
+	parser.add_argument('--extract',help = 'folder to save the frames around each event to')
+	parser.add_argument('--before',type = int,default = 5,help = 'frames to save before each event')
+	parser.add_argument('--after',type = int,default = 15,help = 'frames to save after each event')
+	args = parser.parse_args()
+	video_location = os.path.join(args.folder,args.name + '.avi')
+	events = load_events(os.path.join(args.folder,args.name + '.events.jsonl'),args.kind)
+	if args.extract is not None: os.makedirs(args.extract,exist_ok = True)
+	for event_number,event in enumerate(events):
+		print('frame {:>7} {:<10} {}'.format(event['frame'],event['kind'],event['text']))
+		if args.extract is None: continue
+		first_frame = max(event['frame'] - args.before,0)
+		frames = read_frames(video_location,first_frame,event['frame'] - first_frame + args.after + 1)
+		for i,frame in enumerate(frames):
+			cv2.imwrite(os.path.join(args.extract,'event_{:04d}_{}_frame_{:07d}.tif'.format(
+				event_number,event['kind'],first_frame + i)),frame)
+	print('{} events'.format(len(events)))
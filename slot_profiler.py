@@ -0,0 +1,81 @@
+import os,io,time,threading,functools
+import cProfile,pstats
+from collections import defaultdict,deque
+import numpy as np
+from PyQt5 import QtCore
+from utils import comment
+
+class slot_profiler():
+	'''
+	opt-in timing of Qt slots. slots are wrapped on their class, so the
+	bound methods still run on the thread their object lives on. the time
+	each call waits in the event queue is measured from the emitting signal
+	when the signal is tracked. optionally runs cProfile per thread while
+	inside a wrapped slot
+	'''
+	def __init__(self,use_cprofile = False,max_samples = 10000):
+		self.use_cprofile = use_cprofile
+		self.counts = defaultdict(int)
+		self.durations = defaultdict(lambda: deque(maxlen = max_samples))
+		self.waits = defaultdict(lambda: deque(maxlen = max_samples))
+		self.emit_times = defaultdict(deque)
+		self.profiles = {}
+		# slots can run inside each other through processEvents, only the outermost toggles cProfile
+		self.local = threading.local()
+
+	def get_profile(self):
+		thread_name = threading.current_thread().name
+		if thread_name not in self.profiles:
+			self.profiles[thread_name] = cProfile.Profile()
+		return self.profiles[thread_name]
+
+	def wrap_slot(self,cls,slot_name):
+		name = '{}.{}'.format(cls.__name__,slot_name)
+		slot = getattr(cls,slot_name)
+
+		@functools.wraps(slot)
+		def timed_slot(*args):
+			start_time = time.perf_counter()
+			emit_times = self.emit_times[name]
+			if len(emit_times) > 0:
+				self.waits[name].append(start_time - emit_times.popleft())
+			depth = getattr(self.local,'depth',0)
+			profile = self.get_profile() if self.use_cprofile and depth == 0 else None
+			if profile is not None: profile.enable()
+			self.local.depth = depth + 1
+			try:
+				return slot(*args)
+			finally:
+				self.local.depth = depth
+				if profile is not None: profile.disable()
+				self.counts[name] += 1
+				self.durations[name].append(time.perf_counter() - start_time)
+		setattr(cls,slot_name,timed_slot)
+
+	def track_signal(self,signal,cls,slot_name):
+		'''
+		timestamps every emit of a signal on the emitting thread so that the
+		wrapped slot can tell how long the call sat in the queue
+		'''
+		name = '{}.{}'.format(cls.__name__,slot_name)
+		emit_times = self.emit_times[name]
+		signal.connect(lambda *args: emit_times.append(time.perf_counter()),QtCore.Qt.DirectConnection)
+
+	def report(self,folder_location = None):
+		for name in sorted(self.counts.keys()):
+			durations = np.array(self.durations[name])*1000
+			line = 'slot {}: {} calls, p50 {:.3f} ms, p99 {:.3f} ms'.format(name,self.counts[name],
+				np.percentile(durations,50),np.percentile(durations,99))
+			if len(self.waits[name]) > 0:
+				waits = np.array(self.waits[name])*1000
+				line += ', queue wait p50 {:.3f} ms, p99 {:.3f} ms'.format(
+					np.percentile(waits,50),np.percentile(waits,99))
+			comment(line)
+		if folder_location is None: return
+		for thread_name,profile in self.profiles.items():
+			s = io.StringIO()
+			pstats.Stats(profile,stream = s).sort_stats('cumulative').print_stats(40)
+			with open(os.path.join(folder_location,'slot_profile_{}.txt'.format(thread_name)),'w') as f:
+				f.write(s.getvalue())
+		if len(self.profiles) > 0:
+			comment('wrote slot profiles for {} threads'.format(len(self.profiles)))
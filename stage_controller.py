@@ -1,11 +1,16 @@
 import serial
+import threading,time
+from collections import defaultdict,deque
 import numpy as np
 from utils import comment
+from session_recorder import record_event
+from registration import estimate_shift,fit_pixel_to_stage,apply_transform,load_calibrations,save_calibrations
 from PyQt5 import QtCore
-import matplotlib.pyplot as plt
 
 class stage_controller(QtCore.QObject):
 	position_return_signal = QtCore.pyqtSignal('PyQt_PyObject')
+	command_signal = QtCore.pyqtSignal('PyQt_PyObject','PyQt_PyObject','PyQt_PyObject')
+	flush_jog_signal = QtCore.pyqtSignal()
 
 	def __init__(self,parent = None):
 		'''
@@ -23,12 +28,26 @@ class stage_controller(QtCore.QObject):
 		self.magnification = 4
 		self.microns_per_pixel = 100/34
 		self.calibration_factor = 1.20*4
+		# pixel to stage transforms measured by calibrate(), keyed by magnification
+		self.calibrations = load_calibrations()
+		self.camera_size = np.array([1024,822])
+		self.window_size = np.array([851,681])
+		self.image_count = 0
 		self.send_receive('SAS 50')
 		# self.lysing_loc = self.get_position_slot()
 		self.lysing = True
 		self.dmf_position = np.array([115175,14228])
 		self.send_receive('BLSH 0')
 		self.steps_between_wells = 4400
+		# commands from other threads are queued onto the stage thread
+		self.queue_lock = threading.Lock()
+		self.queue_depth = 0
+		self.pending_jog = [0,0]
+		self.pending_jog_count = 0
+		self.jog_enqueue_time = None
+		self.command_latencies = defaultdict(lambda: deque(maxlen = 1000))
+		self.command_signal.connect(self.command_slot)
+		self.flush_jog_signal.connect(self.flush_jog_slot)
 
 	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject','PyQt_PyObject','PyQt_PyObject')	
 	def reticle_and_center_slot(self,center_x,center_y,reticle_x,reticle_y):
@@ -38,6 +57,66 @@ class stage_controller(QtCore.QObject):
 		self.reticle_y = reticle_y
 		# print('RETICLE RECEIVED!')
 
+	def vid_process_slot(self,image):
+		# connected directly so this runs on the video thread
+		self.image = image
+		self.image_count += 1
+
+	def get_settled_image(self,settle_time = .5,timeout = 3):
+		'''
+		returns a frame grabbed after the stage has had settle_time to stop,
+		or None if no new frames arrive within timeout
+		'''
+		time.sleep(settle_time)
+		start_count = self.image_count
+		deadline = time.time() + timeout
+		while self.image_count < start_count + 2:
+			if time.time() > deadline: return None
+			time.sleep(.01)
+		return self.image.copy()
+
+	def calibrate(self,min_response = .05):
+		'''
+		makes known relative moves around the current position, measures the
+		image shift for each by phase correlation, and fits the linear pixel
+		to stage transform for the current objective. gives up if the camera
+		stops sending frames
+		'''
+		step = max(2,int(30*4/self.magnification))
+		directions = [(1,0),(-1,0),(0,1),(0,-1),(1,1),(-1,-1),(1,-1),(-1,1)]
+		pixel_vectors = []
+		stage_moves = []
+		previous = self.get_settled_image()
+		if previous is None:
+			comment('calibration aborted, no frames from the camera')
+			return
+		total_move = np.zeros(2,dtype = int)
+		for direction in directions:
+			move = np.array(direction)*step
+			self.send_receive('GR,{},{}'.format(move[0],move[1]))
+			total_move += move
+			current = self.get_settled_image()
+			if current is None:
+				comment('calibration aborted, no frames from the camera')
+				# the moves cancel out over a full calibration, so undo the ones made so far
+				self.send_receive('GR,{},{}'.format(-total_move[0],-total_move[1]))
+				return
+			shift,response = estimate_shift(previous,current)
+			previous = current
+			comment('calibration move {} shifted image by {} (response {:.3f})'.format(move,shift,response))
+			if response < min_response: continue
+			# content moved by shift, so this move brings a target at -shift to the reticle
+			pixel_vectors.append(-shift)
+			stage_moves.append(move)
+		if len(stage_moves) < 3:
+			comment('calibration failed, only {} usable moves'.format(len(stage_moves)))
+			return
+		transform,rms_error = fit_pixel_to_stage(pixel_vectors,stage_moves)
+		self.calibrations[self.magnification] = transform
+		save_calibrations(self.calibrations)
+		comment('calibrated {}x pixel to stage transform: {} rms error {:.2f} steps'.format(
+			self.magnification,transform.tolist(),rms_error))
+
 	def change_magnification(self,index):
 		map_dict = {
 		0:4,
@@ -75,6 +154,8 @@ class stage_controller(QtCore.QObject):
 		sends command and handles any errors from stage
 		'''
 		command_string = '{}\r'.format(command)
+		# G and GR are the absolute and relative moves
+		if command.startswith('G'): record_event('stage_move',command)
 		if(not suppress_msg):
 			comment('sending command to stage:{}'.format(command_string))
 		self.ser.write(command_string.encode('utf-8'))
@@ -143,6 +224,71 @@ class stage_controller(QtCore.QObject):
 	def move_last(self):
 		return self.move_relative(self.reverse_move_vector)
 
+	def queue_command(self,command,*args):
+		'''
+		runs a command on the stage thread, safe to call from any thread
+		'''
+		with self.queue_lock: self.queue_depth += 1
+		self.command_signal.emit(command,args,time.time())
+
+	@QtCore.pyqtSlot('PyQt_PyObject','PyQt_PyObject','PyQt_PyObject')
+	def command_slot(self,command,args,enqueue_time):
+		with self.queue_lock: self.queue_depth -= 1
+		command(*args)
+		self.command_latencies[command.__name__].append(time.time() - enqueue_time)
+
+	def queue_jog(self,x,y):
+		'''
+		adds a relative move to the pending jog. jogs requested while the
+		stage is still busy are merged into a single GR move
+		'''
+		with self.queue_lock:
+			self.pending_jog[0] += x
+			self.pending_jog[1] += y
+			self.pending_jog_count += 1
+			if self.jog_enqueue_time is not None: return
+			self.jog_enqueue_time = time.time()
+			self.queue_depth += 1
+		self.flush_jog_signal.emit()
+
+	@QtCore.pyqtSlot()
+	def flush_jog_slot(self):
+		with self.queue_lock:
+			x,y = self.pending_jog
+			jog_count = self.pending_jog_count
+			enqueue_time = self.jog_enqueue_time
+			self.pending_jog = [0,0]
+			self.pending_jog_count = 0
+			self.jog_enqueue_time = None
+			self.queue_depth -= 1
+		if jog_count > 1: comment('merged {} jogs into one move'.format(jog_count))
+		if x != 0 or y != 0: self.send_receive('GR,{},{}'.format(x,y))
+		self.command_latencies['jog'].append(time.time() - enqueue_time)
+
+	def jog_up(self):
+		self.queue_jog(0,-self.step_size)
+
+	def jog_down(self):
+		self.queue_jog(0,self.step_size)
+
+	def jog_right(self):
+		self.queue_jog(self.step_size,0)
+
+	def jog_left(self):
+		self.queue_jog(-self.step_size,0)
+
+	def get_queue_stats(self):
+		'''
+		current queue depth and the latency from request to completion
+		of the recent commands of each type
+		'''
+		stats = {'queue depth':self.queue_depth}
+		for name,latencies in list(self.command_latencies.items()):
+			stats[name] = {'count':len(latencies),
+				'mean latency':float(np.mean(latencies)),
+				'max latency':float(np.max(latencies))}
+		return stats
+
 	def remove_calibrated_error(self,x,y):
 		# an attempt to calibrate out some error...
 		if self.magnification == 4:			
@@ -157,16 +303,30 @@ class stage_controller(QtCore.QObject):
 	def scale_move_vector(self,vector):
 		return vector/self.magnification * self.microns_per_pixel * self.calibration_factor				
 
+	def pixel_to_stage(self,pixel_vector,remove_error = False):
+		'''
+		converts a vector in camera pixels to stage steps using the measured
+		transform for the current objective, falling back to the hand tuned
+		window scaling when this objective has not been calibrated
+		'''
+		if self.magnification in self.calibrations:
+			step_vector = apply_transform(self.calibrations[self.magnification],pixel_vector)
+			return np.rint(step_vector).astype(int)
+		window_vector = pixel_vector*self.window_size/self.camera_size
+		step_vector = self.scale_move_vector(window_vector)
+		if remove_error == True:
+			return self.remove_calibrated_error(step_vector[0],step_vector[1])
+		return step_vector
+
 
 	def click_move_slot(self,click_x,click_y):
 		# center movement:
 		# window_center = np.array([851/2,681/2])
 		# reticle movement:
-		window_center = np.array([self.reticle_x*851/1024,self.reticle_y*681/822])
-		mouse_click_location = np.array([click_x,click_y])
-		pixel_move_vector = mouse_click_location - window_center
-		step_move_vector = self.scale_move_vector(pixel_move_vector)
-		step_move_vector = self.remove_calibrated_error(step_move_vector[0],step_move_vector[1])
+		reticle = np.array([self.reticle_x,self.reticle_y])
+		mouse_click_location = np.array([click_x,click_y])*self.camera_size/self.window_size
+		pixel_move_vector = mouse_click_location - reticle
+		step_move_vector = self.pixel_to_stage(pixel_move_vector,remove_error = True)
 		comment('click move vector: {}'.format(step_move_vector))
 		return self.move_relative(step_move_vector)
 
@@ -178,7 +338,7 @@ class stage_controller(QtCore.QObject):
 				reticle = np.array([self.reticle_x,self.reticle_y]) 
 				center_to_reticle = center - reticle
 				move_vector += center_to_reticle
-			move_vector = self.scale_move_vector(move_vector)
+			move_vector = self.pixel_to_stage(move_vector)
 			self.move_relative(move_vector)
 		elif move_relative == False and scale_vector == False:
 			# print(move_vector)			
@@ -193,8 +353,8 @@ class stage_controller(QtCore.QObject):
 		if(move_vector[0] == 0 and  move_vector[1] == 0):
 			return
 					
-		pixel_move_vector = np.array([move_vector[0], move_vector[1]])
-		step_move_vector = self.scale_move_vector(pixel_move_vector)
+		pixel_move_vector = np.array([move_vector[0], move_vector[1]])*self.camera_size/self.window_size
+		step_move_vector = self.pixel_to_stage(pixel_move_vector)
 		self.move_relative(step_move_vector)
 
 
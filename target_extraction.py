@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+
+# one row per target, in the pixel coordinates of the thresholded network output
+target_dtype = np.dtype([
+	('label',np.int32),
+	('x',np.float32),
+	('y',np.float32),
+	('area',np.int32),
+	('bbox',np.int32,(4,)),
+	('confidence',np.float32),
+	('class',np.int8)])
+
+class_dict = {'red':0,'green':1,'green hope':2}
+
+def get_probability_image(segmented_image,cell_type):
+	# the network output channel that threshold_based_on_type thresholds
+	if cell_type == 'green': return segmented_image[:,:,1]
+	if cell_type == 'red': return segmented_image[:,:,2]
+	return segmented_image
+
+def extract_targets(confidence_image,probability_image = None,cell_type = 'red',min_area = 20):
+	'''
+	finds the targets in a thresholded image with a single connected
+	components pass. returns the structured target array and the label
+	image, which get_target_contours needs if the targets are to be traced.
+	confidence is the mean network probability over each target
+	'''
+	num_labels,labels,stats,centroids = cv2.connectedComponentsWithStats(
+		np.uint8(confidence_image),connectivity = 8)
+	areas = stats[:,cv2.CC_STAT_AREA]
+	# label 0 is the background
+	keep = np.flatnonzero(areas[1:] > min_area) + 1
+	targets = np.zeros(len(keep),dtype = target_dtype)
+	targets['label'] = keep
+	targets['x'] = centroids[keep,0]
+	targets['y'] = centroids[keep,1]
+	targets['area'] = areas[keep]
+	targets['bbox'] = stats[keep,:4]
+	targets['class'] = class_dict.get(cell_type,-1)
+	if probability_image is None:
+		targets['confidence'] = 1
+	else:
+		sums = np.bincount(labels.ravel(),weights = probability_image.ravel(),minlength = num_labels)
+		targets['confidence'] = sums[keep]/areas[keep]
+	return targets,labels
+
+def get_target_contours(targets,labels):
+	'''
+	outer contour of each target, only computed on the target's bounding box
+	'''
+	contours = []
+	for target in targets:
+		x,y,w,h = target['bbox']
+		mask = np.uint8(labels[y:y + h,x:x + w] == target['label'])
+		found = cv2.findContours(mask,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE,offset = (int(x),int(y)))
+		# opencv 3 returns the image as well as the contours
+		target_contours = found[-2]
+		contours.append(max(target_contours,key = len))
+	return contours
+
+def get_target_centers(targets):
+	return np.stack([targets['x'],targets['y']],axis = -1)
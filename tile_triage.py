@@ -0,0 +1,50 @@
+import time
+import cv2
+import numpy as np
+
+class tile_triage():
+	'''
+	cheap check on a downsampled frame to decide whether a tile could
+	contain target cells before running the localizer network on it
+	'''
+	def __init__(self,min_contrast = 2.,min_channel_excess = None,downsample = 8):
+		# min_contrast is the std of the grayscale tile, min_channel_excess is the
+		# 99th percentile of how far the target colour channel stands above the others
+		self.min_contrast = min_contrast
+		self.min_channel_excess = min_channel_excess
+		self.downsample = downsample
+		self.reset()
+
+	def reset(self):
+		self.tiles_checked = 0
+		self.tiles_skipped = 0
+		self.processing_times = []
+
+	def get_statistics(self,img,cell_type):
+		small = cv2.resize(img,(img.shape[1]//self.downsample,img.shape[0]//self.downsample),
+			interpolation = cv2.INTER_AREA).astype(np.float32)
+		contrast = float(cv2.cvtColor(small,cv2.COLOR_BGR2GRAY).std())
+		b,g,r = small[:,:,0],small[:,:,1],small[:,:,2]
+		if cell_type == 'red':
+			excess = r - (g + b)/2
+		else:
+			excess = g - (r + b)/2
+		return contrast,float(np.percentile(excess,99))
+
+	def should_process(self,img,cell_type):
+		contrast,channel_excess = self.get_statistics(img,cell_type)
+		process = contrast >= self.min_contrast
+		if self.min_channel_excess is not None:
+			process = process and channel_excess >= self.min_channel_excess
+		self.tiles_checked += 1
+		if not process: self.tiles_skipped += 1
+		return process,contrast,channel_excess
+
+	def add_processing_time(self,processing_time):
+		self.processing_times.append(processing_time)
+
+	def summary(self):
+		mean_time = np.mean(self.processing_times) if len(self.processing_times) > 0 else 0.
+		return 'skipped {} of {} tiles ({:.0f}%), saving about {:.1f}s'.format(
+			self.tiles_skipped,self.tiles_checked,
+			100.*self.tiles_skipped/max(self.tiles_checked,1),self.tiles_skipped*mean_time)
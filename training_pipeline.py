@@ -0,0 +1,89 @@
+'''
+feeds the localizer training from a chunked_dataset. batches are read and
+augmented by a keras Sequence, so fit_generator can build them in parallel
+worker processes and keep a queue of them ready ahead of the model
+'''
+import time
+import numpy as np
+import cv2
+from keras.utils import Sequence
+from keras.callbacks import Callback
+
+def random_pair_transform(x,y,random_state,rotation_range = 90.,shift_range = .05,flip = True):
+	'''
+	applies the same random rotation, shift and flips to an image and its
+	mask, like a pair of ImageDataGenerators sharing a seed
+	'''
+	h,w = x.shape[:2]
+	matrix = cv2.getRotationMatrix2D((w/2.,h/2.),random_state.uniform(-rotation_range,rotation_range),1)
+	matrix[:,2] += random_state.uniform(-shift_range,shift_range,2)*[w,h]
+	x = cv2.warpAffine(x,matrix,(w,h),flags = cv2.INTER_LINEAR,borderMode = cv2.BORDER_REPLICATE).reshape(x.shape)
+	y = cv2.warpAffine(y,matrix,(w,h),flags = cv2.INTER_LINEAR,borderMode = cv2.BORDER_REPLICATE).reshape(y.shape)
+	if flip and random_state.rand() < .5: x,y = x[:,::-1],y[:,::-1]
+	if flip and random_state.rand() < .5: x,y = x[::-1],y[::-1]
+	return x,y
+
+class augmented_sequence(Sequence):
+	'''
+	batches of augmented pairs from a chunked_dataset. samples are shuffled
+	within chunks and the chunks are shuffled, so each batch only touches a
+	few chunks on disk
+	'''
+	def __init__(self,dataset,batch_size = 8,augment = True,shuffle = True,seed = 1,**transform_args):
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.augment = augment
+		self.shuffle = shuffle
+		self.seed = seed
+		self.transform_args = transform_args
+		self.epoch = 0
+		self.order = self.get_order()
+
+	def get_order(self):
+		chunk_indices = [np.arange(start,start + length) for start,length in
+			zip(self.dataset.chunk_starts,self.dataset.chunk_lengths)]
+		if not self.shuffle: return np.concatenate(chunk_indices)
+		random_state = np.random.RandomState(self.seed + self.epoch)
+		random_state.shuffle(chunk_indices)
+		for indices in chunk_indices: random_state.shuffle(indices)
+		return np.concatenate(chunk_indices)
+
+	def __len__(self):
+		return int(np.ceil(len(self.dataset)/float(self.batch_size)))
+
+	def __getitem__(self,batch_number):
+		indices = self.order[batch_number*self.batch_size:(batch_number + 1)*self.batch_size]
+		x,y = self.dataset.get_samples(indices)
+		if not self.augment: return x,y
+		# seeded per batch so the workers don't all draw the same transforms
+		random_state = np.random.RandomState(self.seed + self.epoch*len(self) + batch_number)
+		for i in range(len(x)):
+			x[i],y[i] = random_pair_transform(x[i],y[i],random_state,**self.transform_args)
+		return x,y
+
+	def on_epoch_end(self):
+		self.epoch += 1
+		self.order = self.get_order()
+
+class throughput_logger(Callback):
+	'''
+	prints training samples/sec as it goes and adds the epoch's rate to the
+	logs, so a CSVLogger after it in the callback list records it
+	'''
+	def __init__(self,print_every = 200):
+		super().__init__()
+		self.print_every = print_every
+
+	def on_epoch_begin(self,epoch,logs = None):
+		self.start_time = time.time()
+		self.samples = 0
+
+	def on_batch_end(self,batch,logs = None):
+		self.samples += (logs or {}).get('size',0)
+		if (batch + 1) % self.print_every == 0:
+			print(' {:.1f} samples/sec'.format(self.samples/(time.time() - self.start_time)))
+
+	def on_epoch_end(self,epoch,logs = None):
+		rate = self.samples/(time.time() - self.start_time)
+		if logs is not None: logs['samples_per_sec'] = rate
+		print('epoch {}: {:.1f} samples/sec'.format(epoch,rate))
@@ -0,0 +1,100 @@
+import time
+from collections import deque
+import cv2
+import numpy as np
+from registration import settle_detector
+
+class clahe_filter():
+	'''
+	contrast limited adaptive histogram equalization on the lightness
+	channel, the CLAHE object is made once rather than on every frame
+	'''
+	def __init__(self,clip_limit = 3.0,tile_grid_size = (8,8)):
+		self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+
+	def apply(self,image):
+		lab= cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+		l, a, b = cv2.split(lab)
+		cl = self.clahe.apply(l)
+		limg = cv2.merge((cl,a,b))
+		return cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+
+class temporal_filter():
+	'''
+	cuts sensor noise by combining the last few frames, either as an
+	exponential running average or as their median. all buffers are
+	allocated on the first frame, and the history is dropped whenever the
+	field of view moves so a stage move never smears the image
+	'''
+	def __init__(self,mode = 'average',alpha = .25,num_frames = 5):
+		# the median is a min/max sorting network, written out for 3 and 5 frames
+		assert mode == 'average' or num_frames in (3,5)
+		self.mode = mode
+		self.alpha = alpha
+		self.num_frames = num_frames
+		self.motion_detector = settle_detector()
+		self.shape = None
+		self.frame_times = deque(maxlen = 1000)
+		self.resets = 0
+
+	def allocate(self,shape):
+		self.shape = shape
+		self.average = np.zeros(shape,np.float32)
+		self.frames = np.zeros((self.num_frames,) + shape,np.uint8)
+		self.scratch = np.zeros((4,) + shape,np.uint8)
+		self.output = np.zeros(shape,np.uint8)
+		self.reset()
+
+	def reset(self):
+		self.count = 0
+		self.index = 0
+
+	def median3(self,a,b,c,out):
+		s = self.scratch
+		np.minimum(a,b,out = s[2])
+		np.maximum(a,b,out = s[3])
+		np.minimum(s[3],c,out = s[3])
+		return np.maximum(s[2],s[3],out = out)
+
+	def median5(self,a,b,c,d,e,out):
+		s = self.scratch
+		np.minimum(a,b,out = s[0])
+		np.maximum(a,b,out = s[1])
+		np.minimum(c,d,out = s[2])
+		np.maximum(c,d,out = s[3])
+		np.maximum(s[0],s[2],out = s[0])
+		np.minimum(s[1],s[3],out = s[1])
+		return self.median3(s[0],s[1],e,out)
+
+	def apply(self,image):
+		start_time = time.perf_counter()
+		if image.shape != self.shape: self.allocate(image.shape)
+		self.motion_detector.update(image)
+		if self.motion_detector.is_moving() and self.count > 0:
+			self.reset()
+			self.resets += 1
+		if self.mode == 'average':
+			if self.count == 0:
+				self.average[...] = image
+			else:
+				cv2.accumulateWeighted(image,self.average,self.alpha)
+			cv2.convertScaleAbs(self.average,self.output)
+		else:
+			self.frames[self.index] = image
+			self.index = (self.index + 1) % self.num_frames
+			if self.count + 1 >= 5 and self.num_frames == 5:
+				self.median5(*self.frames,out = self.output)
+			elif self.count + 1 >= 3:
+				# the newest 3 frames until the buffer has filled
+				newest = [self.frames[(self.index - i) % self.num_frames] for i in (1,2,3)]
+				self.median3(*newest,out = self.output)
+			else:
+				self.output[...] = image
+		self.count += 1
+		self.frame_times.append(time.perf_counter() - start_time)
+		return self.output
+
+	def summary(self):
+		if len(self.frame_times) == 0: return 'temporal filter not used'
+		return 'temporal {} filter: {:.2f} ms per frame over the last {} frames, reset {} times on motion'.format(
+			self.mode,1000*np.mean(self.frame_times),len(self.frame_times),self.resets)